@@ -1,17 +1,121 @@
-from telegram import Update, ReplyKeyboardMarkup, Bot, ReplyKeyboardRemove
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler
+from telegram import Update, ReplyKeyboardMarkup, Bot, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, \
+    InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler, \
+    CallbackQueryHandler, InlineQueryHandler
 from telegram.error import BadRequest, NetworkError
+import asyncio
 import logging
-import datetime, pytz
-import pandas as pd
-import sqlite3
+import datetime
+import os
 import re
-
-# Disable SettingWithCopyWarning that arises from the way I handle personal dealdines.
-pd.options.mode.chained_assignment = None
-
-# Import of deadline data from the source file. Sheet name is specific for the Term that was currently underway.
-df = pd.read_excel('Term2DL.xlsx', sheet_name="Term 5")
+import sys
+import threading
+import time
+
+from aio import AsyncRuntime
+from broadcast import Broadcaster
+from calendar_feed import CalendarServer, etag, feed_token, render_calendar
+from catalogs import Catalogs
+from course_search import normalize
+from flood import FloodControl, throttled
+from leader import LeaderLock
+from logging_setup import log_context, setup_logging
+from metrics import REGISTRY, MetricsServer, log_summaries, timed
+from outbox import Outbox
+from paging import split_text, take_page
+from records import Task
+from reply_cache import ReplyCache
+from scheduler import ReminderScheduler, parse_reminder_time
+from storage import Database, OUTBOX_MIGRATIONS, SUBSCRIPTIONS_MIGRATIONS, TASKS_MIGRATIONS, migrate, \
+    parse_user_date
+from task_import import MAX_FILE_SIZE, parse_tasks
+from webhook import WebhookServer
+
+# Import of deadline data. Every sheet of the workbooks in DEADLINE_WORKBOOKS (comma separated) is a catalog
+# of one term or cohort, chats pick theirs in the menu and get DEFAULT_CATALOG until they do.
+# Parsed sheets are cached in <workbook>.snapshot, so Excel (and pandas) is only loaded again after a file is edited.
+# Dates are parsed and sorted once here, handlers and jobs only slice the indexes.
+catalogs = Catalogs(os.environ.get('DEADLINE_WORKBOOKS', 'Term2DL.xlsx').split(','),
+                    default=os.environ.get('DEFAULT_CATALOG', 'Term 5'))
+# Course-wide replies are the same for every user of a catalog, so they are rendered once per day.
+replies = ReplyCache()
+# Answers to inline queries, kept apart so the many different queries typed don't push the pages out of replies
+inline_answers = ReplyCache(maxsize=512)
+# Calendar feeds of chats, dropped when the sheet is reloaded or the tasks of the chat change
+feeds = ReplyCache(maxsize=2048)
+
+
+def on_deadlines_reload(reloaded):
+    """
+    Drops replies rendered from the old data once an edited workbook has been swapped in, the bot keeps running.
+    Only the views that can show a changed row are dropped: the date, all-courses and inline views of a changed
+    catalog and the views of its changed courses. Course views are numbered, so if a course appeared or
+    disappeared all of them go.
+    :param reloaded: Catalogs with the new indexes and the changes of the reload
+    """
+    changes = reloaded.changes
+    if changes is None:
+        replies.clear()
+        inline_answers.clear()
+        feeds.clear()
+        return
+    stale = {}
+    for catalog, change in changes.items():
+        deadlines = reloaded.get(catalog)
+        added = {}
+        for row in change.added:
+            added[row.course] = added.get(row.course, 0) + 1
+        if any(row.course not in deadlines.by_course for row in change.removed) \
+                or any(count == len(deadlines.by_course[course]) for course, count in added.items()):
+            stale[catalog] = None
+        else:
+            stale[catalog] = {'c%d' % deadlines.course_numbers[course] for course in change.courses}
+
+    def stale_view(view):
+        if view[0] not in stale:
+            return False
+        courses = stale[view[0]]
+        return courses is None or not re.fullmatch(r'c\d+', view[1]) or view[1] in courses
+
+    dropped = replies.discard_if(stale_view) + inline_answers.discard_if(stale_view)
+    feeds.discard_if(lambda chat_id: catalog_of(chat_id) in stale)
+    logger.info("Deadlines changed in %s, %s cached replies dropped", ', '.join(sorted(stale)) or "no catalog",
+                dropped)
+
+
+catalogs.on_reload.append(on_deadlines_reload)
+
+# Shared connections to the personal tasks and subscriptions databases, see storage.py
+todo_db = Database('2DO.db')
+migrate(todo_db, TASKS_MIGRATIONS)
+subscriptions_db = Database('Subscriptions.db')
+migrate(subscriptions_db, SUBSCRIPTIONS_MIGRATIONS)
+# Catalog chosen by every chat, read on each request, so it is kept in memory
+chat_catalogs = dict(subscriptions_db.query("SELECT chat_id, catalog FROM chat_catalogs"))
+
+# Reminder mailouts are written to the outbox first and then sent concurrently, but within Telegram flood limits
+outbox_db = Database('Outbox.db')
+migrate(outbox_db, OUTBOX_MIGRATIONS)
+outbox = Outbox(outbox_db)
+broadcaster = Broadcaster(workers=8, global_rate=25, per_chat_rate=1)
+# Every subscriber gets reminders at their own time, one scheduler thread serves all of them
+reminders = ReminderScheduler()
+
+# Long deadline lists are sent one page at a time with a "Next page" button, REPLY_PAGING=0 sends all pages at once
+PAGING = os.environ.get('REPLY_PAGING', '1') != '0'
+NO_DEADLINES = "Seems like there are no deadlines due in this period.\n"
+STALE_LIST = "This list has changed since, please request it again.\n"
+# Catalogs with more courses than this are searched by typing a part of the name instead of a keyboard of all courses
+COURSE_KEYBOARD_LIMIT = 12
+# Telegram keeps answers to inline queries for this many seconds and serves repeated queries without asking the bot
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 300))
+
+
+def catalog_of(chat_id):
+    """
+    Function returns the name of the catalog (term or cohort) a chat has chosen, the default catalog if none.
+    """
+    return catalogs.resolve(chat_catalogs.get(chat_id))
 
 
 def next_weekday(d, weekday):
@@ -23,110 +127,223 @@ def next_weekday(d, weekday):
     return d + datetime.timedelta(days_ahead)
 
 
-def prepare_output(frame):
+def format_due(deadline):
+    return deadline.date.strftime("%d-%b-%Y") if deadline.date is not None else "TBD"
+
+
+def render_deadline(deadline):
+    """
+    Renders one Deadline record of the deadline index.
+    """
+    return ("Subject: " + deadline.course + "\n"
+            "Assignment: " + deadline.assignment + "\n"
+            "Date: " + format_due(deadline) + "\n"
+            "Weight: " + "{:.0%}".format(deadline.weight) + "\n\n")
+
+
+def prepare_output(rows):
     '''Function to create an output sequence.
-        Input: Pre-filtered DataFrame with deadlines
+        Input: Pre-filtered list of deadline rows from the deadline index
         Output: String that is being fed to bot output
     '''
-    outp_string = ""
-    if len(frame) == 0:
-        return "Seems like there are no deadlines due in this period.\n"
-    else:
-        for i in frame.values:
-            outp_string += "Subject: "
-            outp_string += i[0]
-            outp_string += "\n"
-            outp_string += "Assignment: "
-            outp_string += i[1]
-            outp_string += "\n"
-            outp_string += "Date: "
-            try:
-                outp_string += datetime.datetime.strftime(i[2], "%d-%b-%Y")
-            except:
-                outp_string += "TBD"
-            outp_string += "\n"
-            outp_string += "Weight: "
-            outp_string += "{:.0%}".format(i[4])
-            outp_string += "\n"
-            outp_string += "\n"
-        return outp_string
-
-
-def get_deadlines(param):
-    '''
-    Function processes DataFrame with deadlines and sends the result to output processing function.
-    Param var is responsible for distinguishing between cases:
-        - param == 0: Need to return all deadlines yet to be due
-        - param == 1: Need to return all deadlines within next week.
-    '''
+    if len(rows) == 0:
+        return NO_DEADLINES
+    return "".join(render_deadline(i) for i in rows)
+
+
+def view_rows(catalog, view):
+    """
+    Function takes deadlines of a view from the deadline index of a catalog.
+    Views are short names so they fit into the callback data of the "Next page" button:
+        - 'upcoming': all deadlines yet to be due
+        - 'sunday': all deadlines until next Sunday
+        - 'courses': deadlines of all courses grouped by course
+        - 'c<number>': deadlines of one course, number comes from deadlines.course_numbers
+    :return: list of rows, None if the view does not exist (e.g. course disappeared after a reload)
+    """
+    deadlines = catalogs.get(catalog)
     today = datetime.datetime.today()
-    df['Date'] = pd.to_datetime(df['Date'])
-    df_new = df[df['Date'] >= today]
-    if param == 1:
-        next_sunday = next_weekday(today, 6)  # 0 = Monday, 1=Tuesday, 2=Wednesday...
-        df_new = df_new[df_new['Date'] <= next_sunday]
-    df_new = df_new.sort_values(by="Date")
-    return prepare_output(df_new)
+    if view == 'upcoming':
+        return deadlines.upcoming(today)
+    if view == 'sunday':
+        return deadlines.between(today, next_weekday(today, 6))  # 0 = Monday, 1=Tuesday, 2=Wednesday...
+    if view == 'courses':
+        return deadlines.all_by_course
+    if view.startswith('c') and view[1:].isdigit() and int(view[1:]) < len(deadlines.courses):
+        return deadlines.course(deadlines.courses[int(view[1:])])
+    return None
+
+
+def get_page(catalog, view, start=0):
+    """
+    Function renders one message-sized page of a view, starting at row start.
+    Pages are the same for every user of a catalog, so they are cached for the rest of the day.
+    :return: (text, next_start), next_start is None on the last page
+    """
+    def render():
+        rows = view_rows(catalog, view)
+        if rows is None or start >= max(len(rows), 1):
+            return STALE_LIST, None
+        if len(rows) == 0:
+            return NO_DEADLINES, None
+        return take_page(rows, render_deadline, start)
+    return replies.get((catalog, view, start), render)
+
+
+def reply_deadlines(message, view):
+    """
+    Function sends a view of the chat's catalog to the user. Long views are split into pages on deadline boundaries:
+    with paging on, only the first page is sent with a "Next page" button, otherwise all pages are sent.
+    :param message: message to reply to
+    :param view: name of the view, see view_rows
+    """
+    catalog = catalog_of(message.chat_id)
+    text, next_start = get_page(catalog, view)
+    while next_start is not None and not PAGING:
+        message.reply_text(text)
+        text, next_start = get_page(catalog, view, next_start)
+    message.reply_text(text, reply_markup=next_page_button(catalog, view, next_start))
+
+
+def next_page_button(catalog, view, next_start):
+    if next_start is None:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        "Next page", callback_data="page|%d|%s|%d" % (catalogs.number(catalog), view, next_start))]])
+
+
+def inline_results(catalog, query):
+    """
+    Function builds the answer to an inline query (@bot week, @bot all, @bot <course name>) from the views of a catalog.
+    Answers don't depend on the user, so they are cached for the rest of the day like the pages they are made of.
+    They are cached by the views they show and not by the typed text, so "stat", "stati" and "statistics"
+    share one answer, and in their own cache, so queries sent on every keystroke don't evict the pages.
+    :param catalog: catalog name
+    :param query: text typed after the bot name
+    :return: list of InlineQueryResultArticle, one per view, with the first page of the view as message text
+    """
+    words = normalize(query)
+    deadlines = catalogs.get(catalog)
+    views = []
+    if words in ('', 'week', 'next', 'sunday', 'next sunday'):
+        views.append(('sunday', "Deadlines until next Sunday"))
+    if words in ('', 'all', 'upcoming'):
+        views.append(('upcoming', "All upcoming deadlines"))
+    if not views:
+        # An index lookup, cheap enough to do before the cache
+        views = [('c%d' % deadlines.course_numbers[name], name) for name in deadlines.search.search(query)]
+
+    def render():
+        results = []
+        for view, title in views:
+            text, next_start = get_page(catalog, view)
+            count = len(view_rows(catalog, view))
+            description = "%d deadlines" % count if next_start is None else "%d deadlines, first page" % count
+            results.append(InlineQueryResultArticle(id=view, title=title, description=description,
+                                                    input_message_content=InputTextMessageContent(text)))
+        return results
+    return inline_answers.get((catalog, 'inline', tuple(views)), render)
+
+
+def calendar_feed(chat_id):
+    """
+    Function builds the iCalendar feed of a chat: all dated deadlines of its catalog and all its personal tasks.
+    :param chat_id: chat the feed belongs to
+    :return: (feed as bytes, ETag of the feed)
+    """
+    def render():
+        catalog = catalog_of(chat_id)
+        tasks = [Task(*row) for row in todo_db.query(
+            "SELECT description, duedate FROM tasks WHERE chat_id = ? AND duedate IS NOT NULL ORDER BY duedate",
+            (chat_id,))]
+        body = render_calendar("Deadlines - %s" % catalog, catalogs.get(catalog).rows, tasks)
+        return body, etag(body)
+    return feeds.get(chat_id, render)
 
 
-def get_personal_deadlines(frame):
+def get_personal_deadlines(tasks):
     """
     Function to get deadlines based on input from SQL db
-    :param frame: unfiltered DataFrame, result of SQL db query
+    :param tasks: Task records of upcoming tasks, already filtered and sorted by the SQL query
     :return: string that is being fed to bot output
     """
-    today = datetime.datetime.today()
-    frame['duedate'] = pd.to_datetime(frame['duedate'], format="%d/%m/%Y")
-    df_new = frame[frame['duedate'] >= today]
-    df_new = df_new.sort_values(by="duedate")
-    if len(df_new) == 0:
+    if len(tasks) == 0:
         outp_string = "Oops, seems you have not added any tasks yet. \n\n"
     else:
         outp_string = ""
-        for i in df_new.values:
-            outp_string += "Task: " + i[2] + "\n"
-            outp_string += "Deadline: " + datetime.datetime.strftime(i[3], "%d-%b-%Y") + "\n\n"
+        for task in tasks:
+            outp_string += "Task: " + task.description + "\n"
+            outp_string += "Deadline: " + datetime.date.fromisoformat(task.duedate).strftime("%d-%b-%Y") + "\n\n"
 
     return outp_string
 
 
 def subscriptions_apply_SQL(update, prelim, weekly):
     """
-    Function to introduce changes to existing SQL database.
+    Function to introduce changes to existing SQL database. There is one row per chat, new settings replace the old ones.
     :param update: link variable that connects bot conversation to the function
     :param prelim: binary variable to identify if a user is willing to receive updates a day before the deadline
     :param weekly: binary variable to identify if a user is willing to receive updates a week before the deadline
     :return: commited changes to the database
     """
-    subs_db = sqlite3.connect("Subscriptions.db")
-    subs_cursor = subs_db.cursor()
-    subs_cursor.execute("INSERT INTO subscriptions VALUES (?,?,?,?);",
-                        (update.message.from_user.full_name, update.message.chat_id, prelim, weekly))
-    subs_db.commit()
-    subs_db.close()
-
-
-bot_token = #insert token here
-updater = Updater(token=bot_token, use_context=True)
-dispatcher = updater.dispatcher
-bot = Bot(token=bot_token)
-job = updater.job_queue
-
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO,
-                    handlers=[
-                        logging.FileHandler('convlogs.txt', mode='a'),
-                        logging.StreamHandler()
-                    ])
+    subscriptions_db.execute("INSERT INTO subscriptions (username, chat_id, upcoming, weekly) VALUES (?,?,?,?) "
+                             "ON CONFLICT (chat_id) DO UPDATE SET username = excluded.username, "
+                             "upcoming = excluded.upcoming, weekly = excluded.weekly;",
+                             (update.message.from_user.full_name, update.message.chat_id, prelim, weekly))
+    # Only the process that sends reminders runs the scheduler, the others pick the change up from the database
+    if leader.held:
+        reminders.set(update.message.chat_id, upcoming=prelim, weekly=weekly)
+
+
+def subscribers(reminder):
+    """
+    Function to get recipients of a reminder, read from the partial index of the reminder type.
+    :param reminder: 'upcoming' for the 24h reminder, 'weekly' for the Sunday reminder
+    :return: list of chat ids
+    """
+    return [chat_id for chat_id, in subscriptions_db.query("SELECT chat_id FROM subscriptions WHERE %s = 1" % reminder)]
+
+
+bot_token = os.environ.get('BOT_TOKEN', '')  # insert token here or set BOT_TOKEN
+# Calendar feeds are served on CALENDAR_PORT, CALENDAR_URL is the public URL that proxies to it
+CALENDAR_URL = os.environ.get('CALENDAR_URL', '').rstrip('/')
+CALENDAR_SECRET = os.environ.get('CALENDAR_SECRET') or bot_token
+
+# Log records are written to convlogs.txt by a background thread, see logging_setup.py.
+# Set LOG_FORMAT=json to get JSON lines with user id and conversation step.
+setup_logging('convlogs.txt', level=logging.INFO, json_format=os.environ.get('LOG_FORMAT') == 'json')
 logger = logging.getLogger(__name__)
 
+
+# Requests per second and burst a single chat is allowed, so one noisy chat can't take over the handler threads
+flood = FloodControl(rate=float(os.environ.get('FLOOD_RATE', 1)), burst=int(os.environ.get('FLOOD_BURST', 5)))
+
+
+def conversation_handler(function):
+    """
+    Decorator for conversation handlers: records latency metrics, tags log records with the user and step
+    and applies per-chat flood control before the handler does any work.
+    """
+    return timed('handler')(log_context(throttled(flood, "Whoa, that's a lot of messages! "
+                                                         "Please wait a few seconds and try again.")(function)))
+
+
+def inline_handler(function):
+    """
+    Decorator for inline query handlers, like conversation_handler but without flood control.
+    Telegram sends a query on almost every keystroke, throttling them would drop the query the user ended up with,
+    and the answers come from the inline_answers cache anyway.
+    """
+    return timed('handler')(log_context(function))
+
 L1, DATEMODE, COURSEMODE, SUBSCRIPTIONSETTINGS, COURSEONLY, \
 PERSONALENTRY, PERSONALDATE, PERSONALADDED, PERSONALEXIT, \
-PERSONALEDITENTRY, PERSONALEDITACTION, PERSONALEDITINPUT = range(12)
+PERSONALEDITENTRY, PERSONALEDITACTION, PERSONALEDITINPUT, REMINDERTIME, CATALOGSELECTION = range(14)
 
 
 #Conversation functions
 
+@conversation_handler
 def start(update: Update, context: CallbackContext):
     """
     Initiates the conversation, presents inline keyboard with options
@@ -135,10 +352,15 @@ def start(update: Update, context: CallbackContext):
     :return: next level of conversation
     """
     reply_keyboard = [['Date', 'Course'],['Personal deadlines','Reminders']]
-    update.message.reply_text("Hey, good to see you! \n"
-                              "Here's how it works:.\n"
-                              "- In the first line of options you can select how to get info about study courses: by date or by course.\n"
-                              "- The next line of options will allow you to add and edit personal deadlines or subscibe to reminders.",
+    intro = ("Hey, good to see you! \n"
+             "Here's how it works:.\n"
+             "- In the first line of options you can select how to get info about study courses: by date or by course.\n"
+             "- The next line of options will allow you to add and edit personal deadlines or subscibe to reminders.")
+    if len(catalogs.names) > 1:
+        reply_keyboard.append(['Term'])
+        intro += "\n- Term lets you switch to the deadlines of another term or cohort, now it's %s." \
+                 % catalog_of(update.message.chat_id)
+    update.message.reply_text(intro,
                               reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True,
                                                                one_time_keyboard=True))
     user = update.message.from_user
@@ -146,6 +368,47 @@ def start(update: Update, context: CallbackContext):
     return L1
 
 
+@conversation_handler
+def catalog_selection(update, context):
+    """
+    Handles selection of Term in the start function, prints out all terms and cohorts the bot has deadlines for.
+    :param update: link to a bot
+    :param context: context variable
+    :return: Next stage of the conversation
+    """
+    logger.info("User %s went to term selection", update.message.from_user.full_name)
+    reply_options = [[x] for x in catalogs.names]
+    update.message.reply_text("Please choose your term or cohort",
+                              reply_markup=ReplyKeyboardMarkup(reply_options, resize_keyboard=True,
+                                                               one_time_keyboard=True))
+    return CATALOGSELECTION
+
+
+@conversation_handler
+def catalog_apply(update, context):
+    """
+    Function to save the term or cohort selected on the previous stage, deadlines and reminders of the chat
+    come from its catalog from now on.
+    :param update: link to a bot
+    :param context: context variable
+    :return: End of the conversation. Asks again if there is no such term.
+    """
+    selection = update.message.text
+    if selection not in catalogs.names:
+        update.message.reply_text("Sorry, I don't know this one. Please choose one of the options")
+        return CATALOGSELECTION
+    subscriptions_db.execute("INSERT INTO chat_catalogs (chat_id, catalog) VALUES (?,?) "
+                             "ON CONFLICT (chat_id) DO UPDATE SET catalog = excluded.catalog;",
+                             (update.message.chat_id, selection))
+    chat_catalogs[update.message.chat_id] = selection
+    feeds.discard(update.message.chat_id)
+    logger.info("User %s selected %s", update.message.from_user.full_name, selection)
+    update.message.reply_text("Done! You'll see deadlines of %s now\n\nClick --> /start to return to menu" % selection,
+                              reply_markup=ReplyKeyboardRemove(True))
+    return ConversationHandler.END
+
+
+@conversation_handler
 def date(update: Update, context: CallbackContext):
     """
     Handles selection of date reply from the start function
@@ -162,6 +425,7 @@ def date(update: Update, context: CallbackContext):
     return DATEMODE
 
 
+@conversation_handler
 def course(update, context):
     """
     Handles selection of Course in the start function
@@ -178,6 +442,7 @@ def course(update, context):
     return COURSEMODE
 
 
+@conversation_handler
 def personal(update, context):
     """
     Handles selection of personal deadlines in start function
@@ -194,100 +459,130 @@ def personal(update, context):
     return PERSONALENTRY
 
 
+@conversation_handler
 def next_sunday(update: Update, context: CallbackContext):
     """
     Handles selection of "By next Sunday" in the previous stage of the date tree.
-    Calls get_deadlines function with parameter 1 that stands for "next sunday".
-    Execution of get_deadlines returns a string and sends it to a user.
+    Sends the "sunday" view of deadlines to a user.
     :param update: link to a bot
     :param context: context variable
     :return: This function ends the conversation
     """
-    update.message.reply_text(get_deadlines(1))
+    reply_deadlines(update.message, 'sunday')
     logger.info("User %s asked for next Sunday deadlines", update.message.from_user.full_name)
     update.message.reply_text("\n \n Click --> /start to return to menu ")
     return ConversationHandler.END
 
 
+@conversation_handler
 def all_deadlines(update, context):
     """
     Handles selection of "all" in the previous stage of the date tree.
-    Calls get_deadlines function with parameter 0 that leads to no filters applied.
-    Execution of get_deadlines returns a string and sends it to a user.
+    Sends the "upcoming" view of deadlines, without date filters, to a user.
     :param update: link to a bot
     :param context: context variable
     :return:  This function ends the conversation
     """
     user = update.message.from_user
     logger.info("User %s asked for all deadlines", user.full_name)
-    update.message.reply_text(get_deadlines(0))
+    reply_deadlines(update.message, 'upcoming')
     update.message.reply_text("\n \n Click --> /start to return to menu")
     return ConversationHandler.END
 
 
+@conversation_handler
 def all_courses(update, context):
     """
     Handles selection of "Show all courses" in course tree.
-    Takes DataFrame with all courses and sorts it by course, prints out the result to user through prepare_output
+    Takes deadlines of all courses grouped by course from the index, prints out the result to user page by page
     :param update: link to a bot
     :param context: context variable
     :return: Ends the conversation
     """
     user = update.message.from_user
     logger.info("User %s asked for all courses", user.full_name)
-    update.message.reply_text(prepare_output(df.sort_values(by="Course")))
+    reply_deadlines(update.message, 'courses')
     update.message.reply_text("\n \n Click --> /start to return to menu ")
     return ConversationHandler.END
 
 
+@conversation_handler
 def course_selection(update, context):
     """
     Handles selection of "Show specific course" in the course tree.
-    Takes unique values from the "Course" column in the DataFrame and prints it out to user in column
+    Takes course names from the deadline index and prints it out to user in column.
+    When there are too many courses for a keyboard, asks to type a part of the course name instead.
     :param update: link to a bot
     :param context: context variable
     :return: Next stage of the conversation in the course tree
     """
-    reply_options = [[x] for x in set(df['Course'].values)]
+    courses = catalogs.get(catalog_of(update.message.chat_id)).courses
+    if len(courses) > COURSE_KEYBOARD_LIMIT:
+        update.message.reply_text("Cool! Now type the course name or a part of it (e.g. \"%s\")"
+                                  % courses[0].split()[0], reply_markup=ReplyKeyboardRemove(True))
+        return COURSEONLY
+    reply_options = [[x] for x in courses]
     update.message.reply_text("Cool! Now choose how you want to see this information",
                               reply_markup=ReplyKeyboardMarkup(reply_options, resize_keyboard=True,
                                                                one_time_keyboard=True))
     return COURSEONLY
 
 
+@conversation_handler
 def print_course(update, context):
     """
     Handles selection of a specific course from the previous stage of the course tree.
-    Filters out the original DataFrame according to the user selection on the previous step
+    Looks up the course typed or selected on the previous step with the course search of the deadline index:
+    a single match prints its deadlines, several matches are offered as a keyboard to choose from.
     :param update: link to a bot
     :param context: context variable
-    :return: Ends the conversation
+    :return: Ends the conversation, stays on this stage if the user has to choose between several courses
     """
     logger.info("User %s asked for specific course", update.message.from_user.full_name)
-    selection = update.message.text
-    update.message.reply_text("You have chosen " + selection)
-    update.message.reply_text(prepare_output(df[df['Course'] == selection]))
+    deadlines = catalogs.get(catalog_of(update.message.chat_id))
+    matches = deadlines.search.search(update.message.text, limit=COURSE_KEYBOARD_LIMIT)
+    if len(matches) > 1:
+        update.message.reply_text("I found several courses, please choose one",
+                                  reply_markup=ReplyKeyboardMarkup([[x] for x in matches], resize_keyboard=True,
+                                                                   one_time_keyboard=True))
+        return COURSEONLY
+    if matches:
+        selection = matches[0]
+        update.message.reply_text("You have chosen " + selection)
+        reply_deadlines(update.message, 'c%d' % deadlines.course_numbers[selection])
+    else:
+        # Free text that is not a course name should not push real courses out of the cache
+        update.message.reply_text("Sorry, I could not find a course like " + update.message.text)
     update.message.reply_text("\n \n Click --> /start to return to menu ")
     return ConversationHandler.END
 
 
+@conversation_handler
 def see_personal(update, context):
     """
     Function handles selection of "Personal deadlines" in the start screen.
-    Sends request to the SQL db, filters out the results to match user full name, prints out the results to a user.
+    Sends request to the SQL db for upcoming tasks of the user, prints out the results to a user.
     :param update: link to a bot
     :param context: context variable
     :return: Ends the conversation
     """
-    logger.info('User '+update.message.from_user.full_name+" went to see personal deadlines")
-    todoDB = sqlite3.connect('2DO.db')
-    fetchedDB = pd.read_sql_query("SELECT * FROM tasks", todoDB)
-    todoDB.close()
-    personalDB = fetchedDB[fetchedDB['username'] == update.message.from_user.full_name]
-    update.message.reply_text(get_personal_deadlines(personalDB)+"Click --> /start to return to menu ")
+    logger.info("User %s went to see personal deadlines", update.message.from_user.full_name)
+    personal_tasks = [Task(*row) for row in todo_db.query(
+        "SELECT description, duedate FROM tasks WHERE username = ? AND duedate > ? ORDER BY duedate",
+        (update.message.from_user.full_name, datetime.date.today().isoformat()))]
+    # Old tasks whose deadline was typed in a form that can't be read, shown as typed so they can be fixed
+    unreadable = todo_db.query("SELECT description, duedate_raw FROM tasks WHERE username = ? AND duedate IS NULL "
+                               "AND duedate_raw IS NOT NULL", (update.message.from_user.full_name,))
+    text = get_personal_deadlines(personal_tasks) if personal_tasks or not unreadable else ""
+    if unreadable:
+        text += "I can't read the deadline of these tasks, please change it in Edit personal deadlines:\n\n"
+        text += "".join("Task: %s\nDeadline: %s\n\n" % row for row in unreadable)
+    for chunk in split_text(text + "Click --> /start to return to menu "):
+        update.message.reply_text(chunk)
     return ConversationHandler.END
 
 
+@conversation_handler
 def add_personal(update, context):
     """
     Polling function that handles the "Add personal deadline" behaviour.
@@ -296,10 +591,13 @@ def add_personal(update, context):
     :param context: context variable
     :return: Next stage of a conversation
     """
-    update.message.reply_text('Type and send the task description you want to add')
+    update.message.reply_text('Type and send the task description you want to add.\n'
+                              'To add many tasks at once, send a CSV or Excel file instead: task descriptions '
+                              'in the first column and deadlines (dd/mm/yyyy) in the second')
     return PERSONALDATE
 
 
+@conversation_handler
 def edit_personal_selection(update, context):
     """
     Handles selection of "Edit personal deadline" behaviour in the personal tree.
@@ -307,13 +605,14 @@ def edit_personal_selection(update, context):
     :param context: context variable
     :return: Next stage of a conversation
     """
-    logger.info("User "+ update.message.from_user.full_name + " wants to edit personal deadlines")
+    logger.info("User %s wants to edit personal deadlines", update.message.from_user.full_name)
     reply_keyboard = [['Change task description'], ['Change task deadline'],['Delete task']]
     update.message.reply_text("Please select what you'd like to do",
                               reply_markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True,one_time_keyboard=True))
     return PERSONALEDITENTRY
 
 
+@conversation_handler
 def edit_personal_course_selection(update,context):
     """
     Function handles selection of either "Change task" options on the previous step in the personal tree.
@@ -324,24 +623,23 @@ def edit_personal_course_selection(update,context):
     :param context: context variable
     :return: If tasks exist, proceeds with the sequence. Otherwise it ends the conversation.
     """
-    todoDB = sqlite3.connect('2DO.db')
-    fetchedDB = pd.read_sql_query("SELECT * FROM tasks", todoDB)
-    todoDB.close()
-    personalDB = fetchedDB[fetchedDB['username'] == update.message.from_user.full_name]
+    personal_tasks = todo_db.query("SELECT description FROM tasks WHERE username = ? ORDER BY duedate",
+                                   (update.message.from_user.full_name,))
     context.user_data['action']= update.message.text
-    logger.info("User "+ update.message.from_user.full_name + " wants to " + update.message.text)
+    logger.info("User %s wants to %s", update.message.from_user.full_name, update.message.text)
 
-    if len(personalDB) == 0:
+    if len(personal_tasks) == 0:
         update.message.reply_text("Seems like you don't have any tasks added yet.\n\nClick --> /start to start over and add a task")
         return ConversationHandler.END
     else:
-        reply_keyboard = [[x] for x in personalDB['description']]
+        reply_keyboard = [[x[0]] for x in personal_tasks]
         update.message.reply_text("Please select a task that you'd like to modify",
                                   reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True,
                                                                    one_time_keyboard=True))
         return PERSONALEDITACTION
 
 
+@conversation_handler
 def edit_personal_action(update, context):
     """
     Function handles selection of "Edit task" option on the previous step in the personal tree
@@ -353,50 +651,51 @@ def edit_personal_action(update, context):
     """
     context.user_data['task'] = update.message.text
     if context.user_data['action'] == 'Delete task':
-        logger.info("User " + update.message.from_user.full_name + " wants to delete personal deadline")
-        todoDB = sqlite3.connect('2DO.db')
-        cursor = todoDB.cursor()
-        cursor.execute("DELETE FROM tasks WHERE username = ? AND description = ?",
-                       (update.message.from_user.full_name, update.message.text))
-        todoDB.commit()
-        todoDB.close()
+        logger.info("User %s wants to delete personal deadline", update.message.from_user.full_name)
+        todo_db.execute("DELETE FROM tasks WHERE username = ? AND description = ?",
+                        (update.message.from_user.full_name, update.message.text))
+        feeds.discard(update.message.chat_id)
         update.message.reply_text("Task was successfully deleted.\n\nClick --> /start to return to menu")
         return ConversationHandler.END
     elif context.user_data['action'] == 'Change task description':
-        logger.info("User "+update.message.from_user.full_name + " wants to change task description")
+        logger.info("User %s wants to change task description", update.message.from_user.full_name)
         update.message.reply_text("Please enter the new description")
         return PERSONALEDITINPUT
     else:
-        logger.info("User "+update.message.from_user.full_name + " wants to change task deadline")
+        logger.info("User %s wants to change task deadline", update.message.from_user.full_name)
         update.message.reply_text("Please enter the new deadline using format dd/mm/yyyy (e.g. 28/02/2021)")
         return PERSONALEDITINPUT
 
 
+@conversation_handler
 def edit_personal_modification(update, context):
     """
     Function to execute modification of a personal task selected on a previous stage of the personal tree.
     :param update: link to a bot
     :param context: context variable
-    :return: Commits the changes and ends the conversation.
+    :return: Commits the changes and ends the conversation. Asks for the deadline again if it can't be parsed.
     """
-    todoDB = sqlite3.connect('2DO.db')
-    cursor = todoDB.cursor()
     if context.user_data['action'] == 'Change task description':
-        cursor.execute('UPDATE tasks SET description = ? WHERE username = ? AND description = ?',
-                       (update.message.text, update.message.from_user.full_name, context.user_data['task']))
-        logger.info("User " + update.message.from_user.full_name + " have modified personal task description")
+        todo_db.execute('UPDATE tasks SET description = ? WHERE username = ? AND description = ?',
+                        (update.message.text, update.message.from_user.full_name, context.user_data['task']))
+        feeds.discard(update.message.chat_id)
+        logger.info("User %s have modified personal task description", update.message.from_user.full_name)
     elif context.user_data['action'] == 'Change task deadline':
-        cursor.execute('UPDATE tasks SET duedate = ? WHERE username = ? AND description = ?',
-                       (update.message.text, update.message.from_user.full_name, context.user_data['task']))
-        logger.info("User " + update.message.from_user.full_name + " have modified personal task deadline")
+        duedate = parse_user_date(update.message.text)
+        if duedate is None:
+            update.message.reply_text("Sorry, I could not read this date. Please use format dd/mm/yyyy (e.g. 28/02/2021)")
+            return PERSONALEDITINPUT
+        todo_db.execute('UPDATE tasks SET duedate = ?, duedate_raw = NULL WHERE username = ? AND description = ?',
+                        (duedate, update.message.from_user.full_name, context.user_data['task']))
+        feeds.discard(update.message.chat_id)
+        logger.info("User %s have modified personal task deadline", update.message.from_user.full_name)
     else:
         logger.info("User typed unrecognized command, SQL will not be executed")
-    todoDB.commit()
-    todoDB.close()
     update.message.reply_text("Task has been successfully updated! \n\nClick --> /start to return to menu")
     return ConversationHandler.END
 
 
+@conversation_handler
 def add_personal_date(update, context):
     """
     Polling function that asks for a new deadline date in personal task modification
@@ -409,27 +708,70 @@ def add_personal_date(update, context):
     return PERSONALADDED
 
 
+@conversation_handler
 def after_added(update, context):
     """
     Function that executes the insertion into the database and ends the "Add personal" tree
     :param update: link to a bot
     :param context: context variable
-    :return: Selection of Personal deadlines or exit
+    :return: Selection of Personal deadlines or exit. Asks for the date again if it can't be parsed.
     """
-    todoDB = sqlite3.connect('2DO.db')
-    cursor = todoDB.cursor()
+    duedate = parse_user_date(update.message.text)
+    if duedate is None:
+        update.message.reply_text('Sorry, I could not read this date. Please use format dd/mm/yyyy (e.g. 28/02/2021)')
+        return PERSONALADDED
     logger.info("User %s added personal deadline", update.message.from_user.full_name)
     reply_keyboard = [['See personal deadlines', 'Return to main menu']]
     update.message.reply_text("Cool! Now choose what you would like to do next",
                               reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True,
                                                                one_time_keyboard=True))
-    cursor.execute("INSERT INTO tasks VALUES (?,?,?,?);",
-                   (update.message.from_user.full_name, update.message.chat_id, context.user_data['description'], update.message.text))
-    todoDB.commit()
-    todoDB.close()
+    todo_db.execute("INSERT INTO tasks (username, chat_id, description, duedate) VALUES (?,?,?,?);",
+                    (update.message.from_user.full_name, update.message.chat_id, context.user_data['description'], duedate))
+    feeds.discard(update.message.chat_id)
     return PERSONALEXIT
 
 
+# Rows with errors listed in the import report, the rest is only counted
+IMPORT_ERRORS_SHOWN = 20
+
+
+@conversation_handler
+def import_tasks(update, context):
+    """
+    Handles an uploaded CSV/Excel file with personal tasks, see task_import.parse_tasks.
+    All readable rows are added in one transaction and the user gets one reply with the rows that were skipped.
+    Works in any state of the conversation and does not change it.
+    :param update: link to a bot
+    :param context: context variable
+    """
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        update.message.reply_text("Sorry, this file is too large, files up to %d KB can be imported"
+                                  % (MAX_FILE_SIZE // 1024))
+        return
+    try:
+        tasks, errors = parse_tasks(document.file_name, bytes(document.get_file().download_as_bytearray()))
+    except ValueError as e:
+        update.message.reply_text("Sorry, I could not import this file: %s" % e)
+        return
+    logger.info("User %s imported %s personal deadlines, %s rows skipped", update.message.from_user.full_name,
+                len(tasks), len(errors))
+    if tasks:
+        todo_db.executemany("INSERT INTO tasks (username, chat_id, description, duedate) VALUES (?,?,?,?);",
+                            [(update.message.from_user.full_name, update.message.chat_id, description, duedate)
+                             for description, duedate in tasks])
+        feeds.discard(update.message.chat_id)
+    report = ["Added %d personal deadline%s." % (len(tasks), '' if len(tasks) == 1 else 's')]
+    if errors:
+        report.append("Skipped rows:")
+        report += ["Row %d: %s" % error for error in errors[:IMPORT_ERRORS_SHOWN]]
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            report.append("... and %d more" % (len(errors) - IMPORT_ERRORS_SHOWN))
+    for chunk in split_text("\n".join(report)):
+        update.message.reply_text(chunk)
+
+
+@conversation_handler
 def subscription_settings(update, context):
     """
     Function that prints out different subscription options along with a short description.
@@ -437,18 +779,20 @@ def subscription_settings(update, context):
     :param context: context variable
     :return: Next stage of the conversation
     """
-    logger.info("User " + update.message.from_user.full_name + " went to subscription settings")
-    reply_options = [['24h reminder','Sunday reminder'], ['Both', 'Cancel reminders']]
+    logger.info("User %s went to subscription settings", update.message.from_user.full_name)
+    reply_options = [['24h reminder','Sunday reminder'], ['Both', 'Cancel reminders'], ['Reminder time']]
     update.message.reply_text('Please choose one of the available options: \n'
                               '- 24h reminder will send you info about deadlines that are due tomorrow;\n'
                               '- Sunday notifications will send you info about deadlines in the upcoming week;\n'
                               '- Or choose to receive both types of notifications.\n'
+                              '- Reminder time lets you choose when and in which time zone reminders arrive.\n'
                               '\n You can also manage notifications if you no longer want to receive any of them. ',
                               reply_markup=ReplyKeyboardMarkup(reply_options, one_time_keyboard=True, resize_keyboard=True))
 
     return SUBSCRIPTIONSETTINGS
 
 
+@conversation_handler
 def subscriptions_apply(update, context):
     """
     Function to fetch user choice from the previous stage and write the changes to the database.
@@ -457,7 +801,7 @@ def subscriptions_apply(update, context):
     :return: End of the conversation
     """
     selection = update.message.text
-    logger.info("User " + update.message.from_user.full_name + " selected " + update.message.text)
+    logger.info("User %s selected %s", update.message.from_user.full_name, update.message.text)
 
     if selection == "Both":
         subscriptions_apply_SQL(update, 1, 1)
@@ -466,15 +810,45 @@ def subscriptions_apply(update, context):
     elif selection == "Sunday reminder":
         subscriptions_apply_SQL(update, 0, 1)
     elif selection == "Cancel reminders":
-        subs_db = sqlite3.connect("Subscriptions.db")
-        subs_cursor = subs_db.cursor()
-        subs_cursor.execute("DELETE FROM subscriptions WHERE username = ?;",(update.message.from_user.full_name,))
-        subs_db.commit()
-        subs_db.close()
+        # Reminder time and time zone stay, they apply again when the user subscribes again
+        subscriptions_apply_SQL(update, 0, 0)
+    elif selection == "Reminder time":
+        update.message.reply_text("Please send the time you'd like to get reminders at in format hh:mm (e.g. 18:30).\n"
+                                  "Add your time zone if it's not CET (e.g. 18:30 Europe/London).",
+                                  reply_markup=ReplyKeyboardRemove(True))
+        return REMINDERTIME
     update.message.reply_text("Thanks! The settings have been updated\n\nClick --> /start to return to menu")
     return ConversationHandler.END
 
 
+@conversation_handler
+def reminder_time_apply(update, context):
+    """
+    Function to save the reminder time and time zone typed on the previous stage and reschedule the user's reminders.
+    :param update: link to a bot
+    :param context: context variable
+    :return: End of the conversation. Asks for the time again if it can't be read.
+    """
+    parsed = parse_reminder_time(update.message.text)
+    if parsed is None:
+        update.message.reply_text("Sorry, I could not read this. Please use format hh:mm, optionally followed by "
+                                  "a time zone (e.g. 18:30 or 18:30 Europe/London)")
+        return REMINDERTIME
+    remind_time, timezone = parsed
+    # Settings are kept even without an active subscription, they apply once the user subscribes
+    subscriptions_db.execute("INSERT INTO subscriptions (username, chat_id, upcoming, weekly, remind_time, timezone) "
+                             "VALUES (?,?,0,0,?,?) ON CONFLICT (chat_id) DO UPDATE SET "
+                             "remind_time = excluded.remind_time, timezone = excluded.timezone;",
+                             (update.message.from_user.full_name, update.message.chat_id, remind_time, timezone))
+    if leader.held:
+        reminders.set(update.message.chat_id, remind_time=remind_time, timezone=timezone)
+    logger.info("User %s set reminder time %s %s", update.message.from_user.full_name, remind_time, timezone)
+    update.message.reply_text("Thanks! Reminders will come at %s %s\n\nClick --> /start to return to menu"
+                              % (remind_time, timezone or "CET"))
+    return ConversationHandler.END
+
+
+@conversation_handler
 def help(update, context):
     """
     [LEGACY] Logger function to notify user that the thing he typed is not supported.
@@ -484,11 +858,12 @@ def help(update, context):
     """
     update.message.reply_text("seems like I don't know this command yet!")
     user = update.message.from_user
-    logger.info("User " + user.first_name + " typed " + update.message.text)
+    logger.info("User %s typed %s", user.first_name, update.message.text)
     update.message.reply_text("\n \n Click --> /start to return to menu ")
     return ConversationHandler.END
 
 
+@conversation_handler
 def timeout(update, context):
     """
     Handler and logger of timeout event. The event itself is set in the conversation outside of the function.
@@ -497,13 +872,14 @@ def timeout(update, context):
     :return: Ends the conversation
     """
     user = update.message.from_user
-    logger.info("User " + user.full_name + " ran out of time")
+    logger.info("User %s ran out of time", user.full_name)
     update.message.reply_text("You haven't selected anything in a minute, so I'm terminating this conversation\n \n"
                               "Click --> /start to return to menu ", reply_markup=ReplyKeyboardRemove(True))
     return ConversationHandler.END
 
 
 def error_handler(update, context):
+    REGISTRY.inc('sdabot_errors_total', error=type(context.error).__name__)
     try:
         raise context.error
     except BadRequest:
@@ -511,97 +887,216 @@ def error_handler(update, context):
     except NetworkError:
         logger.info("A network error occurred")
 
+
+@inline_handler
+def inline_query(update, context):
+    """
+    Handles inline queries, so deadlines can be looked up and shared in any chat without going through the menu.
+    Inline mode has to be switched on for the bot in BotFather.
+    :param update: link to a bot
+    :param context: context variable
+    """
+    query = update.inline_query
+    # In a private chat the chat id is the user id, so the user gets the catalog chosen in the bot menu
+    catalog = catalog_of(query.from_user.id)
+    logger.info("User %s made inline query %s", query.from_user.full_name, query.query)
+    query.answer(inline_results(catalog, query.query), cache_time=INLINE_CACHE_TIME,
+                 is_personal=len(catalogs.names) > 1)
+
+
+@conversation_handler
+def calendar_link(update, context):
+    """
+    Handles /calendar, sends the link to the chat's calendar feed that calendar apps can subscribe to.
+    :param update: link to a bot
+    :param context: context variable
+    """
+    if not CALENDAR_URL:
+        update.message.reply_text("Sorry, calendar feeds are not available at the moment")
+        return
+    logger.info("User %s asked for the calendar link", update.message.from_user.full_name)
+    update.message.reply_text("Subscribe to this link in your calendar app to get course deadlines and personal tasks "
+                              "there, it stays up to date by itself:\n%s/calendar/%d/%s.ics"
+                              % (CALENDAR_URL, update.message.chat_id, feed_token(CALENDAR_SECRET, update.message.chat_id)))
+
+
+@conversation_handler
+def next_page(update, context):
+    """
+    Handles the "Next page" button under a long deadline list. Works outside of the conversation as well,
+    the button carries the catalog, the view and the position of the next page in its callback data.
+    :param update: link to a bot
+    :param context: context variable
+    """
+    query = update.callback_query
+    query.answer()
+    _, number, view, start = query.data.split('|')
+    catalog = catalogs.by_number(int(number))
+    if catalog is None:
+        text, next_start = STALE_LIST, None
+    else:
+        text, next_start = get_page(catalog, view, int(start))
+    # The button is moved to the new page, so the list is always continued from its end
+    query.edit_message_reply_markup(reply_markup=None)
+    query.message.reply_text(text, reply_markup=next_page_button(catalog, view, next_start))
+
 '''Job functions'''
 
+def build_reminders(heading, course_rows, chat_ids, personal_tasks):
+    """
+    Function to assemble reminder messages for all subscribers at once.
+    Personal tasks are grouped by chat in a single pass and the course block is rendered once,
+    so the work grows with subscribers + tasks rather than subscribers * tasks.
+    :param heading: first line of the reminder
+    :param course_rows: course deadlines due in the reminder window, from the deadline index
+    :param chat_ids: chats subscribed to this reminder
+    :param personal_tasks: (chat_id, description, duedate) rows of personal tasks due in the reminder window
+    :return: list of (chat_id, text) messages, chats with nothing due are skipped
+    """
+    tasks_by_chat = {}
+    for chat_id, description, duedate in personal_tasks:
+        tasks_by_chat.setdefault(chat_id, []).append(Task(description, duedate))
+    course_block = prepare_output(course_rows) if len(course_rows) > 0 else None
+    messages = []
+    for i in dict.fromkeys(chat_ids):
+        personal_task_list = tasks_by_chat.get(i)
+        if course_block is None and personal_task_list is None:
+            continue
+        parts = [heading]
+        if course_block is not None:
+            parts.append(course_block)
+            if personal_task_list is not None:
+                parts.append("And also something personal\n\n")
+        if personal_task_list is not None:
+            parts.append(get_personal_deadlines(personal_task_list))
+        parts.append('Click --> /start to go to menu')
+        messages.append((i, "".join(parts)))
+    return messages
+
+
+# Reminder headings and how many days ahead each reminder looks
+REMINDER_WINDOWS = {
+    'daily': ('Hi! There are some tasks due tomorrow!\n\n', 1),
+    'weekly': ('Hi! There are some tasks due next week!\n\n', 7),
+}
+
+
+def send_reminders(bot, kind, reminder_date, chat_ids):
+    """
+    Function to perform a reminder mailout to a batch of subscribers.
+    First it takes the deadlines index of every catalog in the batch and picks line items that are due within
+    the reminder window, then the personal tasks of the batch due in the same window. Messages are put into the outbox
+    and sent through the rate-limited broadcaster. Sending the same reminder of a day twice does nothing.
+    :param bot: telegram Bot
+    :param kind: 'daily' or 'weekly'
+    :param reminder_date: date the reminder belongs to, in the time zone of the subscribers. The window is counted
+        from it and not from the server date: a reminder sent in the evening in America is already the next day here
+    :param chat_ids: chats to remind
+    """
+    heading, days = REMINDER_WINDOWS[kind]
+    # Everything due in the days after reminder_date: tomorrow for the daily reminder, next week for the weekly one
+    start = datetime.datetime.combine(reminder_date + datetime.timedelta(days=1), datetime.time.min)
+    until = datetime.datetime.combine(reminder_date + datetime.timedelta(days=days), datetime.time.max)
+    personal_tasks = []
+    # SQLite limits the number of parameters of a statement, big batches are queried in parts
+    for part in range(0, len(chat_ids), 500):
+        batch = chat_ids[part:part + 500]
+        personal_tasks += todo_db.query("SELECT chat_id, description, duedate FROM tasks WHERE chat_id IN (%s) "
+                                        "AND duedate > ? AND duedate <= ? ORDER BY duedate" % ",".join("?" * len(batch)),
+                                        (*batch, reminder_date.isoformat(), until.date().isoformat()))
+    by_catalog = {}
+    for chat_id in chat_ids:
+        by_catalog.setdefault(catalog_of(chat_id), []).append(chat_id)
+    messages = []
+    for catalog, catalog_chats in by_catalog.items():
+        messages += build_reminders(heading, catalogs.get(catalog).between(start, until), catalog_chats, personal_tasks)
+    logger.info("%s reminder: %s new messages in the outbox", kind.capitalize(),
+                outbox.enqueue(kind, reminder_date, messages))
+    report = outbox.drain(bot, broadcaster)
+    logger.info("%s reminder: %s", kind.capitalize(), report)
+
+
+# Changed rows listed in a change notice, the rest is only counted
+CHANGE_LINES = 30
+
+
+def describe_changes(catalog, change):
+    """
+    Function renders a short notice of what a reload changed in a catalog, one line per changed row.
+    :param catalog: catalog name
+    :param change: DeadlineChanges of the catalog
+    :return: notice text
+    """
+    lines = []
+    for row in change.added:
+        lines.append("+ %s: %s, due %s, weight %s" % (row.course, row.assignment, format_due(row),
+                                                     "{:.0%}".format(row.weight)))
+    for row in change.removed:
+        lines.append("- %s: %s" % (row.course, row.assignment))
+    for old, new in change.moved:
+        lines.append("~ %s: %s moved from %s to %s" % (new.course, new.assignment, format_due(old), format_due(new)))
+    for old, new in change.reweighted:
+        lines.append("~ %s: %s weight %s -> %s" % (new.course, new.assignment, "{:.0%}".format(old.weight),
+                                                  "{:.0%}".format(new.weight)))
+    if len(lines) > CHANGE_LINES:
+        lines[CHANGE_LINES:] = ["... and %d more changes" % (len(lines) - CHANGE_LINES)]
+    return "Deadlines of %s have changed:\n%s\n\nClick --> /start to see the deadlines" % (catalog, "\n".join(lines))
+
+
+def notify_changes(bot, reloaded):
+    """
+    Function sends the changes of a reload to the subscribers of the changed catalogs, through the outbox
+    and the broadcaster like reminders. A reload that added or removed whole catalogs is not described.
+    :param bot: telegram Bot
+    :param reloaded: Catalogs with the changes of the reload
+    """
+    if not reloaded.changes:
+        return
+    notices = {}
+    messages = []
+    for chat_id, in subscriptions_db.query("SELECT chat_id FROM subscriptions WHERE upcoming = 1 OR weekly = 1"):
+        catalog = catalog_of(chat_id)
+        if catalog in reloaded.changes:
+            if catalog not in notices:
+                notices[catalog] = describe_changes(catalog, reloaded.changes[catalog])
+            messages.append((chat_id, notices[catalog]))
+    if not messages:
+        return
+    # Timestamped so a second edit on the same day is a new mailout, not a duplicate of the first one
+    logger.info("Deadline changes: %s new messages in the outbox",
+                outbox.enqueue('changes', datetime.datetime.now().replace(microsecond=0), messages))
+    logger.info("Deadline changes: %s", outbox.drain(bot, broadcaster))
+
+
+@timed('job')
 def daily_reminder(context):
     """
-    Function to perform daily reminder mailout.
-    First it takes the deadlines DataFrame, analyses if any of line items are due tomorrow.
-    Then it analyses if there are any customers that have subscribed to the daily notifications and sends messages to them.
+    Function to perform daily reminder mailout to all subscribers at once, regardless of their reminder time.
+    Scheduled reminders go through the reminders scheduler, this is for manual runs.
     :param context: context variable
-    :return: Standard message sent to subscribed users.
     """
-    today = datetime.datetime.today()
-    tomorrow = datetime.datetime.today() + datetime.timedelta(days=1)
-    df_new = df[df['Date'] >= today]
-    df_new = df_new[df_new['Date'] <= tomorrow]
-    subs_db = sqlite3.connect('Subscriptions.db')
-    mailout_list = pd.read_sql_query("SELECT * FROM subscriptions", subs_db)
-    subs_db.close()
-    personal_db = sqlite3.connect('2DO.db')
-    tasks_list = pd.read_sql_query("SELECT * FROM tasks", personal_db)
-    tasks_list['duedate'] = pd.to_datetime(tasks_list['duedate'], format="%d/%m/%Y")
-    personal_db.close()
-    personal_tomorrow = tasks_list[tasks_list['duedate']>=today]
-    personal_tomorrow = personal_tomorrow[personal_tomorrow['duedate']<=tomorrow]
-    tomorrow_list = mailout_list[mailout_list['upcoming'] == 1]
-    tomorrow_list.drop_duplicates(inplace=True)
-    for i in tomorrow_list['chat_id']:
-        personal_task_list = personal_tomorrow[personal_tomorrow['chat_id']==i]
-        if len(df_new)>0 and len(personal_task_list)>0:
-            output_text = 'Hi! There are some tasks due tomorrow!\n\n'
-            output_text+=prepare_output(df_new)
-            output_text+="And also something personal\n\n"
-            output_text+=get_personal_deadlines(personal_task_list)
-            output_text+='Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        elif len(df_new)==0 and len(personal_task_list)>0:
-            output_text = 'Hi! There are some tasks due tomorrow!\n\n'
-            output_text += get_personal_deadlines(personal_task_list)
-            output_text += 'Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        elif len(df_new)>0 and len(personal_task_list)==0:
-            output_text = 'Hi! There are some tasks due tomorrow!\n\n'
-            output_text += prepare_output(df_new)
-            output_text += 'Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        else:
-            continue
+    send_reminders(context.bot, 'daily', datetime.date.today(), subscribers('upcoming'))
 
+
+@timed('job')
 def weekly_reminder(context):
     """
-    Function to perform weekly reminder mailout.
-    First it takes the deadlines DataFrame, analyses if any of line items are due till Sunday next week.
-    Then it analyses if there are any customers that have subscribed to the daily notifications and sends messages to them.
+    Function to perform weekly reminder mailout to all subscribers at once, regardless of their reminder time.
+    Scheduled reminders go through the reminders scheduler, this is for manual runs.
     :param context: context variable
-    :return: Standard message sent to subscribed users.
     """
-    today = datetime.datetime.today()
-    week_more = datetime.datetime.today() + datetime.timedelta(days=7)
-    df_new = df[df['Date'] >= today]
-    df_new = df_new[df_new['Date'] <= week_more]
-    subs_db = sqlite3.connect('Subscriptions.db')
-    mailout_list = pd.read_sql_query("SELECT * FROM subscriptions", subs_db)
-    subs_db.close()
-    personal_db = sqlite3.connect('2DO.db')
-    tasks_list = pd.read_sql_query("SELECT * FROM tasks", personal_db)
-    tasks_list['duedate'] = pd.to_datetime(tasks_list['duedate'], format="%d/%m/%Y")
-    personal_db.close()
-    personal_next_week = tasks_list[tasks_list['duedate']>=today]
-    personal_next_week = personal_next_week[personal_next_week['duedate']<=week_more]
-    tomorrow_list = mailout_list[mailout_list['upcoming'] == 1]
-    tomorrow_list.drop_duplicates(inplace=True)
-    for i in tomorrow_list['chat_id']:
-        personal_task_list = personal_next_week[personal_next_week['chat_id']==i]
-        if len(df_new)>0 and len(personal_task_list)>0:
-            output_text = 'Hi! There are some tasks due next week!\n\n'
-            output_text+=prepare_output(df_new)
-            output_text+="And also something personal\n\n"
-            output_text+=get_personal_deadlines(personal_task_list)
-            output_text+='Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        elif len(df_new)==0 and len(personal_task_list)>0:
-            output_text = 'Hi! There are some tasks due next week!\n\n'
-            output_text += get_personal_deadlines(personal_task_list)
-            output_text += 'Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        elif len(df_new)>0 and len(personal_task_list)==0:
-            output_text = 'Hi! There are some tasks due next week!\n\n'
-            output_text += prepare_output(df_new)
-            output_text += 'Click --> /start to go to menu'
-            context.bot.send_message(chat_id=i, text=output_text)
-        else:
-            continue
+    send_reminders(context.bot, 'weekly', datetime.date.today(), subscribers('weekly'))
+
+
+@timed('job')
+def resume_outbox(bot):
+    """
+    Function to send reminder messages left in the outbox, e.g. when the bot was restarted in the middle of a mailout.
+    :param bot: telegram Bot
+    """
+    report = outbox.drain(bot, broadcaster)
+    if report.sent or report.failed:
+        logger.info("Resumed reminder delivery: %s", report)
 
 
 '''Main body'''
@@ -611,8 +1106,11 @@ conversation = ConversationHandler(
     states={
         L1: [MessageHandler(Filters.regex('Date'), date), MessageHandler(Filters.regex('Course'), course),
              MessageHandler(Filters.regex('Personal'), personal),
-             MessageHandler(Filters.regex('Reminders'), subscription_settings)],
+             MessageHandler(Filters.regex('Reminders'), subscription_settings),
+             MessageHandler(Filters.regex('Term'), catalog_selection)],
+        CATALOGSELECTION: [MessageHandler(Filters.text, catalog_apply)],
         SUBSCRIPTIONSETTINGS: [MessageHandler(Filters.text, subscriptions_apply)],
+        REMINDERTIME: [MessageHandler(Filters.text, reminder_time_apply)],
         DATEMODE: [MessageHandler(Filters.regex('By next Sunday'), next_sunday),
                    MessageHandler(Filters.regex('Show all'), all_deadlines)],
         COURSEMODE: [MessageHandler(Filters.regex('Show all courses'), all_courses),
@@ -640,14 +1138,231 @@ legacy_course = CommandHandler('course', all_courses)
 legacy_study = CommandHandler('study', all_deadlines)
 legacy_next_sunday = MessageHandler(Filters.regex(re.compile(r'By next Sunday', re.IGNORECASE)), next_sunday)
 
-job.run_daily(daily_reminder, time=datetime.time(10,8,00,tzinfo=pytz.timezone("CET")))
-job.run_daily(weekly_reminder, time=datetime.time(19,0,00,tzinfo=pytz.timezone("CET")), days=[6])
+# "Next page" button under long deadline lists
+paging_buttons = CallbackQueryHandler(next_page, pattern=r'^page\|')
+# Inline mode, @bot <query> in any chat
+inline_deadlines = InlineQueryHandler(inline_query)
+calendar_command = CommandHandler('calendar', calendar_link)
+# CSV/Excel upload with personal tasks, accepted in any state of the conversation
+task_upload = MessageHandler(Filters.document, import_tasks)
+
+
+def build_updater():
+    """
+    Creates the Updater with the conversation and legacy handlers registered.
+    Reminders are not JobQueue jobs, they are sent by the reminders scheduler, see start_reminders.
+    """
+    updater = Updater(token=bot_token, use_context=True)
+    dispatcher = updater.dispatcher
+
+    dispatcher.add_handler(conversation)
+    dispatcher.add_error_handler(error_handler)
+    dispatcher.add_handler(legacy_next)
+    dispatcher.add_handler(legacy_course)
+    dispatcher.add_handler(legacy_study)
+    dispatcher.add_handler(legacy_next_sunday)
+    dispatcher.add_handler(paging_buttons)
+    dispatcher.add_handler(inline_deadlines)
+    dispatcher.add_handler(calendar_command)
+    dispatcher.add_handler(task_upload)
+    REGISTRY.gauge('sdabot_update_queue_depth', dispatcher.update_queue.qsize)
+    return updater
 
-dispatcher.add_handler(conversation)
-dispatcher.add_error_handler(error_handler)
-dispatcher.add_handler(legacy_next)
-dispatcher.add_handler(legacy_course)
-dispatcher.add_handler(legacy_study)
-dispatcher.add_handler(legacy_next_sunday)
 
-updater.start_polling()
\ No newline at end of file
+# Held by the one process that sends reminders, see start_scheduling and run_worker
+leader = LeaderLock(os.environ.get('LEADER_LOCK', 'Reminders.lock'))
+
+
+def start_reminders(bot):
+    """
+    Resumes the outbox, loads reminder settings of all subscribers and starts the reminders scheduler.
+    Deadline change notices are sent with the same bot. Only called by the process holding the leader lock.
+    :param bot: telegram Bot the reminders are sent with
+    """
+    threading.Thread(target=resume_outbox, args=(bot,), name='outbox-resume', daemon=True).start()
+    reminders.deliver = timed('job', 'reminders')(lambda kind, day, chat_ids: send_reminders(bot, kind, day, chat_ids))
+    catalogs.on_reload.append(timed('job', 'changes')(lambda reloaded: notify_changes(bot, reloaded)))
+    reminders.load(subscriptions_db.query("SELECT chat_id, upcoming, weekly, remind_time, timezone FROM subscriptions"))
+    logger.info("Reminders scheduled: %s", len(reminders))
+    reminders.start()
+
+
+# Seconds between re-reading settings that other processes may have changed, see reload_settings
+SETTINGS_REFRESH = int(os.environ.get('SETTINGS_REFRESH', 60))
+
+
+def reload_settings(reschedule=True):
+    """
+    Reads the catalog choices and reminder settings of all chats from the database again.
+    Handlers keep them in memory of their own process, so this is how a process picks up the changes made
+    by the handlers of the other instances.
+    :param reschedule: also update the reminders scheduler, only for the process that sends reminders
+    """
+    chat_catalogs.update(subscriptions_db.query("SELECT chat_id, catalog FROM chat_catalogs"))
+    if reschedule:
+        changed = reminders.sync(subscriptions_db.query("SELECT chat_id, upcoming, weekly, remind_time, timezone "
+                                                        "FROM subscriptions"))
+        if changed:
+            logger.info("Reminder settings of %s chats changed", changed)
+
+
+def watch_settings():
+    """
+    Starts a background thread that calls reload_settings every SETTINGS_REFRESH seconds.
+    The reminders scheduler is updated too once this process holds the leader lock.
+    """
+    def loop():
+        while True:
+            time.sleep(SETTINGS_REFRESH)
+            try:
+                reload_settings(reschedule=leader.held)
+            except Exception:
+                logger.exception("Failed to reload settings")
+
+    threading.Thread(target=loop, name='settings', daemon=True).start()
+
+
+def start_webhook(bot):
+    """
+    Starts the webhook endpoint and tells Telegram to push updates to it.
+    Configured with WEBHOOK_URL (public URL that proxies to this endpoint), WEBHOOK_SECRET,
+    WEBHOOK_HOST and WEBHOOK_PORT environment variables.
+    :param bot: telegram Bot
+    :return: started WebhookServer
+    """
+    secret = os.environ['WEBHOOK_SECRET']
+    server = WebhookServer(secret, host=os.environ.get('WEBHOOK_HOST', '127.0.0.1'),
+                           port=int(os.environ.get('WEBHOOK_PORT', 8443)))
+    server.start()
+    REGISTRY.gauge('sdabot_webhook_queue_depth', server.updates.qsize)
+    REGISTRY.gauge('sdabot_webhook_queue_max_depth', lambda: server.counters['max_depth'])
+    for name in server.counters:
+        if name != 'max_depth':
+            REGISTRY.gauge('sdabot_webhook_requests', lambda name=name: server.counters[name], result=name)
+    bot.set_webhook(url=os.environ['WEBHOOK_URL'], api_kwargs={'secret_token': secret})
+    return server
+
+
+def start_scheduling(bot, schedule):
+    """
+    Starts the reminders of an interactive instance if it can take the leader lock. If another process holds
+    the lock, the instance waits for it in the background and takes over when the holder exits, so two instances
+    never send the same reminders. Instances with reminders left to a reminder worker (--no-reminders) never send.
+    All instances keep their settings in sync with what the other instances write.
+    """
+    def standby():
+        logger.info("Another process holds %s and sends reminders, waiting to take over", leader.path)
+        leader.wait()
+        logger.info("Took over sending reminders, holding %s", leader.path)
+        start_reminders(bot)
+
+    if schedule and leader.acquire():
+        start_reminders(bot)
+    elif schedule:
+        threading.Thread(target=standby, name='leader-standby', daemon=True).start()
+    watch_settings()
+
+
+def run_polling(schedule=True):
+    """
+    Default mode: Updater long polling, handlers run on the dispatcher worker threads.
+    :param schedule: send reminders from this process, False when a reminder worker runs
+    """
+    updater = build_updater()
+    start_scheduling(updater.bot, schedule)
+    # Pick up edits of the deadlines sheet without a restart, so ongoing conversations are not dropped
+    catalogs.watch(interval=60)
+    updater.start_polling()
+
+
+def run_webhook(schedule=True):
+    """
+    Webhook mode (python SDABot.py --webhook): updates are pushed by Telegram to the embedded endpoint, see webhook.py.
+    They are handled one by one from the endpoint queue, the same way the dispatcher handles polled updates.
+    :param schedule: send reminders from this process, False when a reminder worker runs
+    """
+    updater = build_updater()
+    server = start_webhook(updater.bot)
+    updater.job_queue.start()
+    start_scheduling(updater.bot, schedule)
+    catalogs.watch(interval=60)
+    while True:
+        data = server.updates.get()
+        updater.dispatcher.process_update(Update.de_json(data, updater.bot))
+
+
+def run_asyncio(webhook=False, schedule=True):
+    """
+    Asyncio mode (python SDABot.py --asyncio): one event loop serves all conversations, see aio.py.
+    Uses the same conversation tree, legacy handlers and jobs as the polling mode.
+    :param webhook: take updates from the webhook endpoint instead of long polling
+    :param schedule: send reminders from this process, False when a reminder worker runs
+    """
+    bot = Bot(token=bot_token)
+    runtime = AsyncRuntime(bot, conversation,
+                           [legacy_next, legacy_course, legacy_study, legacy_next_sunday, paging_buttons,
+                            inline_deadlines, calendar_command, task_upload],
+                           error_handler)
+    start_scheduling(bot, schedule)
+    catalogs.watch(interval=60)
+    if webhook:
+        asyncio.run(runtime.run_webhook(start_webhook(bot)))
+    else:
+        asyncio.run(runtime.run_polling())
+
+
+def run_worker():
+    """
+    Worker mode (python SDABot.py --worker): sends reminders, resumes the outbox and sends deadline change notices,
+    but handles no updates. Bot instances are then started with --no-reminders, as many as needed, and a big
+    mailout no longer takes CPU from their handlers.
+    Only the process holding the leader lock (LEADER_LOCK file) sends, so subscribers never get a reminder twice.
+    Other workers wait as standbys and take over when the leader exits.
+    Calendar feeds are not served by the worker, its metrics endpoint is on WORKER_METRICS_PORT.
+    """
+    if not leader.acquire():
+        logger.info("Another process holds %s, waiting to take over", leader.path)
+        leader.wait()
+    logger.info("Reminder worker started, holding %s", leader.path)
+    start_reminders(Bot(token=bot_token))
+    # Change notices are sent on reloads, so the worker watches the workbooks too
+    catalogs.watch(interval=60)
+    watch_settings()
+    threading.Event().wait()
+
+
+def start_metrics(port_variable='METRICS_PORT', calendar=True):
+    """
+    Starts the Prometheus endpoint on the port in port_variable (if set), the calendar feeds on CALENDAR_PORT
+    (if set and wanted) and the periodic metrics summary in the log.
+    :param port_variable: environment variable with the metrics port, processes sharing an environment use different ones
+    :param calendar: serve calendar feeds, only bot instances do
+    """
+    if os.environ.get(port_variable):
+        MetricsServer(port=int(os.environ[port_variable])).start()
+    if calendar and os.environ.get('CALENDAR_PORT'):
+        calendar = CalendarServer(calendar_feed, CALENDAR_SECRET, port=int(os.environ['CALENDAR_PORT']))
+        calendar.start()
+        for name in calendar.counters:
+            REGISTRY.gauge('sdabot_calendar_requests', lambda name=name: calendar.counters[name], result=name)
+    REGISTRY.gauge('sdabot_reply_cache_size', lambda: replies.stats()['size'])
+    REGISTRY.gauge('sdabot_reply_cache_hits', lambda: replies.hits)
+    REGISTRY.gauge('sdabot_reply_cache_misses', lambda: replies.misses)
+    REGISTRY.gauge('sdabot_reply_cache_coalesced', lambda: replies.coalesced)
+    log_summaries(interval=300)
+
+
+if __name__ == '__main__':
+    # --no-reminders: a reminder worker (--worker) sends reminders for this instance
+    schedule = '--no-reminders' not in sys.argv[1:]
+    if '--worker' in sys.argv[1:]:
+        start_metrics('WORKER_METRICS_PORT', calendar=False)
+        run_worker()
+        sys.exit()
+    start_metrics()
+    if '--asyncio' in sys.argv[1:]:
+        run_asyncio(webhook='--webhook' in sys.argv[1:], schedule=schedule)
+    elif '--webhook' in sys.argv[1:]:
+        run_webhook(schedule)
+    else:
+        run_polling(schedule)
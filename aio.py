@@ -0,0 +1,358 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+from metrics import REGISTRY
+from storage import deferred_writes, flush_writes
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBot:
+    """
+    Awaitable front of a telegram Bot.
+    The Bot itself does blocking HTTP calls, they run on a small fixed pool of sender threads,
+    so the number of threads depends on the pool size and not on how many conversations are in flight.
+    """
+
+    def __init__(self, bot, senders=8):
+        """
+        :param bot: telegram Bot
+        :param senders: number of concurrent Bot API calls
+        """
+        self.bot = bot
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=senders, thread_name_prefix='sender')
+
+    async def call(self, method, **kwargs):
+        """
+        Awaits a Bot API method, e.g. await bot.call('send_message', chat_id=1, text='Hi')
+        """
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._pool, functools.partial(getattr(self.bot, method), **kwargs))
+        except Exception:
+            REGISTRY.inc('sdabot_send_errors_total', send=method)
+            raise
+        finally:
+            REGISTRY.observe('sdabot_send_seconds', time.perf_counter() - started, send=method)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+class BufferedMessage:
+    """
+    Message passed to handlers in asyncio mode.
+    reply_text only records the reply, the runtime awaits all recorded Bot API calls once the handler returns,
+    so a handler thread is never held up by a Telegram round-trip. Everything else comes from the real message.
+    """
+
+    def __init__(self, message, calls):
+        self._message = message
+        self._calls = calls
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def reply_text(self, text, **kwargs):
+        self._calls.append(('send_message', dict(kwargs, chat_id=self._message.chat_id, text=text)))
+
+
+class BufferedCallbackQuery:
+    """
+    Callback query (inline button press) passed to handlers in asyncio mode, its calls are recorded like replies.
+    """
+
+    def __init__(self, query, calls):
+        self._query = query
+        self._calls = calls
+        self.message = BufferedMessage(query.message, calls) if query.message is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def answer(self, **kwargs):
+        self._calls.append(('answer_callback_query', dict(kwargs, callback_query_id=self._query.id)))
+
+    def edit_message_reply_markup(self, **kwargs):
+        self._calls.append(('edit_message_reply_markup', dict(kwargs, chat_id=self._query.message.chat_id,
+                                                              message_id=self._query.message.message_id)))
+
+
+class BufferedInlineQuery:
+    """
+    Inline query passed to handlers in asyncio mode, its answer is recorded like replies.
+    """
+
+    def __init__(self, query, calls):
+        self._query = query
+        self._calls = calls
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def answer(self, results, **kwargs):
+        self._calls.append(('answer_inline_query', dict(kwargs, inline_query_id=self._query.id, results=results)))
+
+
+class BufferedUpdate:
+    """
+    Update passed to handlers in asyncio mode, its message, callback query and inline query only record
+    Bot API calls in calls.
+    """
+
+    def __init__(self, update):
+        self._update = update
+        self.calls = []
+        self.message = BufferedMessage(update.message, self.calls) if update.message is not None else None
+        self.callback_query = BufferedCallbackQuery(update.callback_query, self.calls) \
+            if update.callback_query is not None else None
+        self.inline_query = BufferedInlineQuery(update.inline_query, self.calls) \
+            if update.inline_query is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._update, name)
+
+
+class AsyncContext:
+    """
+    Stand-in for CallbackContext with the attributes the handlers use.
+    """
+
+    def __init__(self, bot, user_data=None, error=None):
+        self.bot = bot
+        self.user_data = user_data if user_data is not None else {}
+        self.error = error
+
+
+class AsyncRuntime:
+    """
+    Asyncio runtime for the bot, an alternative to Updater polling with dispatcher worker threads.
+    It reuses the same ConversationHandler definition (entry points, states, fallbacks and timeout),
+    so the conversation goes through exactly the same states as in polling mode.
+        - Updates of one chat are handled in order, different chats are handled concurrently.
+        - Handlers run on a fixed pool of handler threads, so their database reads and file downloads never
+          block the event loop. Their replies, button answers and database writes are collected while they run
+          and then awaited: writes on a single writer thread, replies through AsyncBot.
+    Reminders are not sent here, see the reminders scheduler in SDABot.start_reminders.
+    """
+
+    def __init__(self, bot, conversation, handlers=(), error_handler=None, senders=8, max_in_flight=256,
+                 handler_threads=16):
+        """
+        :param bot: telegram Bot
+        :param conversation: ConversationHandler with the conversation tree
+        :param handlers: handlers that are checked when the conversation does not take the update
+        :param error_handler: function (update, context) called when a handler raises
+        :param senders: number of concurrent Bot API calls
+        :param max_in_flight: maximum number of updates processed at the same time
+        :param handler_threads: number of handlers that run at the same time
+        """
+        self.bot = AsyncBot(bot, senders=senders)
+        self.conversation = conversation
+        self.handlers = list(handlers)
+        self.error_handler = error_handler
+        self.states = {}
+        self.user_data = collections.defaultdict(dict)
+        self._locks = {}
+        self._timeouts = {}
+        self._handler_pool = concurrent.futures.ThreadPoolExecutor(max_workers=handler_threads,
+                                                                   thread_name_prefix='handler')
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._max_in_flight = max_in_flight
+        self._in_flight = None
+        self.in_flight = 0
+
+    @staticmethod
+    def _key(update):
+        return update.effective_chat.id, update.effective_user.id
+
+    def _select(self, handlers, update):
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler
+        return None
+
+    @staticmethod
+    def _call_handler(handler, update, context):
+        with deferred_writes() as writes:
+            return handler.callback(update, context), writes
+
+    async def _run_handler(self, handler, update, context):
+        """
+        Calls a handler on a handler thread, then applies its database writes and sends its replies.
+        :return: value returned by the handler
+        """
+        buffered = BufferedUpdate(update)
+        loop = asyncio.get_running_loop()
+        try:
+            result, writes = await loop.run_in_executor(self._handler_pool, self._call_handler, handler, buffered,
+                                                        context)
+            if writes:
+                await loop.run_in_executor(self._writer, flush_writes, writes)
+            for method, kwargs in buffered.calls:
+                await self.bot.call(method, **kwargs)
+        except Exception as e:
+            await self._handle_error(update, e)
+            return None
+        return result
+
+    async def _handle_error(self, update, error):
+        if self.error_handler is None:
+            logger.exception("Error while handling an update", exc_info=error)
+            return
+        try:
+            self.error_handler(update, AsyncContext(self.bot.bot, error=error))
+        except Exception:
+            logger.exception("Unhandled error while handling an update", exc_info=error)
+
+    def _set_state(self, key, new_state, update):
+        timer = self._timeouts.pop(key, None)
+        if timer is not None:
+            timer[1].cancel()
+        if new_state == ConversationHandler.END:
+            self.states.pop(key, None)
+            return
+        if new_state is not None:
+            self.states[key] = new_state
+        if key in self.states and self.conversation.conversation_timeout:
+            # The token tells a timeout that already fired apart from the one set by a newer update
+            token = object()
+            handle = asyncio.get_running_loop().call_later(
+                self.conversation.conversation_timeout,
+                lambda: asyncio.ensure_future(self._trigger_timeout(key, update, token)))
+            self._timeouts[key] = (token, handle)
+
+    async def _trigger_timeout(self, key, update, token):
+        try:
+            await self._timeout(key, update, token)
+        except Exception as e:
+            await self._handle_error(update, e)
+
+    async def _timeout(self, key, update, token):
+        async with self._lock(key):
+            timer = self._timeouts.get(key)
+            if timer is None or timer[0] is not token:
+                return
+            del self._timeouts[key]
+            if self.states.pop(key, None) is None:
+                return
+            timeout_handlers = self.conversation.states.get(ConversationHandler.TIMEOUT, [])
+            handler = self._select(timeout_handlers, update)
+            if handler is not None:
+                await self._run_handler(handler, update, AsyncContext(self.bot.bot, self.user_data[key[1]]))
+
+    def _lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def process_update(self, update):
+        """
+        Routes one update through the conversation the same way ConversationHandler does,
+        and through the additional handlers if the conversation does not take it.
+        Updates without a chat (inline queries) only go to the additional handlers.
+        """
+        if update.effective_user is None:
+            return
+        if update.effective_chat is None:
+            handler = self._select(self.handlers, update)
+            if handler is not None:
+                context = AsyncContext(self.bot.bot, self.user_data[update.effective_user.id])
+                await self._run_handler(handler, update, context)
+            return
+        key = self._key(update)
+        async with self._lock(key):
+            context = AsyncContext(self.bot.bot, self.user_data[key[1]])
+            state = self.states.get(key)
+            if state is None:
+                handler = self._select(self.conversation.entry_points, update)
+            else:
+                handler = self._select(self.conversation.states.get(state, []), update) \
+                          or self._select(self.conversation.fallbacks, update)
+            if handler is not None:
+                new_state = await self._run_handler(handler, update, context)
+                self._set_state(key, new_state, update)
+                return
+            handler = self._select(self.handlers, update)
+            if handler is not None:
+                await self._run_handler(handler, update, context)
+
+    async def _process_bounded(self, update):
+        try:
+            await self.process_update(update)
+        except Exception as e:
+            # Handler errors are reported by _run_handler, this catches the rest, e.g. a failing check_update
+            await self._handle_error(update, e)
+        finally:
+            self.in_flight -= 1
+            self._in_flight.release()
+
+    async def submit(self, update):
+        """
+        Schedules an update for processing, waits only if max_in_flight updates are already being processed.
+        """
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+            REGISTRY.gauge('sdabot_updates_in_flight', lambda: self.in_flight)
+        await self._in_flight.acquire()
+        self.in_flight += 1
+        asyncio.ensure_future(self._process_bounded(update))
+
+    async def _prepare(self):
+        # CommandHandler needs the bot username, Bot fetches it with a blocking get_me on first use
+        while True:
+            try:
+                await self.bot.call('get_me')
+                return
+            except Exception as e:
+                await self._handle_error(None, e)
+                await asyncio.sleep(1)
+
+    async def run_polling(self, poll_timeout=30):
+        """
+        Long-polls Telegram for updates and processes them until cancelled.
+        :param poll_timeout: long polling timeout in seconds
+        """
+        await self._prepare()
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await self.bot.call('get_updates', offset=offset, timeout=poll_timeout)
+                except Exception as e:
+                    await self._handle_error(None, e)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    await self.submit(update)
+        finally:
+            self._handler_pool.shutdown(wait=False)
+            self.bot.close()
+
+    async def run_webhook(self, server):
+        """
+        Processes updates received by a started WebhookServer until cancelled.
+        :param server: WebhookServer, its queue is drained here
+        """
+        await self._prepare()
+        loop = asyncio.get_running_loop()
+        pump = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='webhook-pump')
+        try:
+            while True:
+                data = await loop.run_in_executor(pump, server.updates.get)
+                await self.submit(Update.de_json(data, self.bot.bot))
+        finally:
+            pump.shutdown(wait=False)
+            self._handler_pool.shutdown(wait=False)
+            self.bot.close()
@@ -0,0 +1,333 @@
+"""
+Load-test and benchmark harness for the bot handlers.
+
+Builds a synthetic deadlines workbook and SQLite databases of the requested size in a temporary directory,
+imports SDABot there and drives the real handlers and reminder jobs with fake Update/Bot objects,
+so nothing is sent to Telegram. For every scenario it reports p50/p95/p99 latency, throughput, peak memory
+and memory allocated per request. Cold start (import time and resident memory of a fresh process) is measured
+in a subprocess, once parsing the workbook and once from the snapshot.
+
+    python benchmark.py --deadlines 2000 --users 5000 --save baseline.json
+    python benchmark.py --deadlines 2000 --users 5000 --compare baseline.json
+"""
+import argparse
+import concurrent.futures
+import datetime
+import importlib
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ['start', 'next_sunday', 'all_deadlines', 'all_courses', 'print_course', 'see_personal', 'after_added',
+             'daily_reminder', 'weekly_reminder']
+# Reminder jobs go through the whole subscriber list, they are run fewer times than the interactive handlers
+JOB_SCENARIOS = {'daily_reminder', 'weekly_reminder'}
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = 'Student%s' % user_id
+        self.full_name = 'Student %s' % user_id
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeMessage:
+    def __init__(self, user_id, text):
+        self.from_user = FakeUser(user_id)
+        self.chat_id = user_id
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text):
+        self.message = FakeMessage(user_id, text)
+        self.effective_chat = FakeChat(user_id)
+        self.effective_user = self.message.from_user
+
+
+class FakeBot:
+    """
+    Bot stand-in that only counts what would have been sent.
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+class FakeContext:
+    def __init__(self, bot, user_data=None):
+        self.bot = bot
+        self.user_data = user_data or {}
+        self.error = None
+
+
+def make_fixtures(directory, courses, deadlines, users, tasks, subscribers, seed=0):
+    """
+    Writes Term2DL.xlsx, 2DO.db and Subscriptions.db with synthetic data into a directory.
+    Dates are spread from a month ago to three months ahead, so every date window has something in it.
+    """
+    rng = random.Random(seed)
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    course_names = ['Course %03d' % i for i in range(courses)]
+    frame = pd.DataFrame({
+        'Course': [rng.choice(course_names) for _ in range(deadlines)],
+        'Assignment': ['Assignment %d' % i for i in range(deadlines)],
+        'Date': [today + datetime.timedelta(days=rng.randint(-30, 90)) for _ in range(deadlines)],
+        'Type': [rng.choice(['Exam', 'Quiz', 'Essay']) for _ in range(deadlines)],
+        'Weight': [rng.choice([0.05, 0.1, 0.2, 0.4]) for _ in range(deadlines)],
+    })
+    frame.to_excel(os.path.join(directory, 'Term2DL.xlsx'), sheet_name='Term 5', index=False)
+
+    todo = sqlite3.connect(os.path.join(directory, '2DO.db'))
+    todo.execute("CREATE TABLE tasks (username TEXT, chat_id INTEGER, description TEXT, duedate TEXT)")
+    rows = []
+    for i in range(tasks):
+        user_id = rng.randrange(users)
+        duedate = (today + datetime.timedelta(days=rng.randint(-30, 60))).strftime("%d/%m/%Y")
+        rows.append((FakeUser(user_id).full_name, user_id, 'Task %d' % i, duedate))
+    todo.executemany("INSERT INTO tasks VALUES (?,?,?,?)", rows)
+    todo.commit()
+    todo.close()
+
+    subs = sqlite3.connect(os.path.join(directory, 'Subscriptions.db'))
+    subs.execute("CREATE TABLE subscriptions (username TEXT, chat_id INTEGER, upcoming INTEGER, weekly INTEGER)")
+    subs.executemany("INSERT INTO subscriptions VALUES (?,?,?,?)",
+                     [(FakeUser(i).full_name, i, rng.randint(0, 1), rng.randint(0, 1))
+                      for i in rng.sample(range(users), min(subscribers, users))])
+    subs.commit()
+    subs.close()
+    return course_names
+
+
+def load_bot(directory):
+    """
+    Imports SDABot with the fixtures of a directory as its data.
+    Reminder mailouts and incoming requests are not rate limited here, the harness measures the bot
+    and not flood limits.
+    """
+    os.chdir(directory)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    bot_module = importlib.import_module('SDABot')
+    bot_module.broadcaster = bot_module.Broadcaster(workers=8, global_rate=10 ** 9, per_chat_rate=10 ** 9)
+    bot_module.flood.rate = bot_module.flood.burst = 10 ** 9
+    return bot_module
+
+
+COLD_START = """
+import json, resource, sys, time
+started = time.perf_counter()
+import SDABot
+print(json.dumps({'import_ms': (time.perf_counter() - started) * 1000,
+                  'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'pandas_loaded': 'pandas' in sys.modules}))
+"""
+
+
+def cold_start(directory):
+    """
+    Imports SDABot in a fresh interpreter inside the fixtures directory.
+    :return: dict with import time in milliseconds, peak resident memory in KiB and whether pandas got loaded
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    output = subprocess.run([sys.executable, '-c', COLD_START], cwd=directory, env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def make_call(bot_module, scenario, users, course_names, rng):
+    """
+    :return: function without arguments that runs one request of the scenario
+    """
+    fake_bot = FakeBot()
+    if scenario in JOB_SCENARIOS:
+        job = getattr(bot_module, scenario)
+        return lambda: job(FakeContext(fake_bot))
+
+    def call():
+        user_id = rng.randrange(users)
+        if scenario == 'print_course':
+            update = FakeUpdate(user_id, rng.choice(course_names))
+        elif scenario == 'after_added':
+            update = FakeUpdate(user_id, (datetime.date.today() + datetime.timedelta(days=rng.randint(1, 60)))
+                                .strftime("%d/%m/%Y"))
+        else:
+            update = FakeUpdate(user_id, '/start')
+        context = FakeContext(fake_bot, {'description': 'Benchmark task'})
+        getattr(bot_module, scenario)(update, context)
+    return call
+
+
+def make_reset(bot_module, scenario):
+    """
+    :return: function without arguments that runs before every request of the scenario without being measured,
+        None if the scenario needs none
+    """
+    if scenario in JOB_SCENARIOS:
+        # The outbox skips a mailout it already has, without this every run after the first would send nothing
+        return lambda: bot_module.outbox_db.execute("DELETE FROM outbox")
+    return None
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(call, iterations, concurrency, reset=None):
+    """
+    Runs a scenario and measures it.
+    :param reset: function run before every call, its time is not counted, see make_reset
+    :return: dict with latency percentiles in milliseconds, throughput in requests per second and peak memory in KiB
+    """
+    reset = reset or (lambda: None)
+    reset()
+    call()  # warm-up, e.g. first connection of a thread or first cache fill
+    latencies = []
+    reset_seconds = []
+
+    def timed():
+        started = time.perf_counter()
+        reset()
+        reset_seconds.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(timed) for _ in range(iterations)]:
+                future.result()
+    else:
+        for _ in range(iterations):
+            timed()
+    elapsed = time.perf_counter() - started - sum(reset_seconds)
+
+    # Memory is measured in a separate short pass, tracemalloc slows everything down and would skew latencies
+    tracemalloc.start()
+    allocated = []
+    peak = 0
+    for _ in range(min(iterations, 20)):
+        reset()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call()
+        call_peak = tracemalloc.get_traced_memory()[1]
+        allocated.append(call_peak - before)
+        peak = max(peak, call_peak)
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': iterations / elapsed,
+        'peak_kib': peak / 1024,
+        'alloc_kib': sum(allocated) / len(allocated) / 1024,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every metric against a baseline.
+    :return: list of (scenario, metric) pairs that regressed by more than threshold
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        if scenario not in baseline:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'peak_kib', 'alloc_kib',
+                       'import_ms', 'max_rss_kib'):
+            if metric not in metrics or metric not in baseline[scenario]:
+                continue
+            before, after = baseline[scenario][metric], metrics[metric]
+            change = (after - before) / before if before else 0.0
+            # Higher throughput is better, for everything else lower is better
+            worse = -change if metric == 'throughput_rps' else change
+            flag = ' REGRESSION' if worse > threshold else ''
+            print('  %-16s %-15s %10.2f -> %10.2f (%+.1f%%)%s' % (scenario, metric, before, after, change * 100, flag))
+            if flag:
+                regressions.append((scenario, metric))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--courses', type=int, default=40)
+    parser.add_argument('--deadlines', type=int, default=500)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=500, help='requests per interactive scenario')
+    parser.add_argument('--job-iterations', type=int, default=5, help='runs per reminder job scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='threads sending requests at the same time')
+    parser.add_argument('--scenarios', nargs='*', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--save', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON file written with --save earlier')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change that counts as a regression')
+    args = parser.parse_args(argv)
+    # The bot is imported from inside the fixtures directory, resolve output paths before changing into it
+    save = args.save and os.path.abspath(args.save)
+    baseline_path = args.compare and os.path.abspath(args.compare)
+
+    directory = tempfile.mkdtemp(prefix='sdabot-bench-')
+    course_names = make_fixtures(directory, args.courses, args.deadlines, args.users, args.tasks, args.subscribers)
+    results = {}
+    # The first start parses the workbook and writes the snapshot, the second one is the usual restart
+    for scenario in ('cold_start_parse', 'cold_start_snapshot'):
+        results[scenario] = r = cold_start(directory)
+        print('%-16s import %8.0f ms  max RSS %8.0f KiB  pandas %s'
+              % (scenario, r['import_ms'], r['max_rss_kib'], 'loaded' if r['pandas_loaded'] else 'not loaded'))
+
+    started = time.perf_counter()
+    bot_module = load_bot(directory)
+    print('Fixtures in %s, bot loaded in %.0f ms' % (directory, (time.perf_counter() - started) * 1000))
+
+    rng = random.Random(1)
+    for scenario in args.scenarios:
+        iterations = args.job_iterations if scenario in JOB_SCENARIOS else args.iterations
+        concurrency = 1 if scenario in JOB_SCENARIOS else args.concurrency
+        results[scenario] = run_scenario(make_call(bot_module, scenario, args.users, course_names, rng),
+                                         iterations, concurrency, make_reset(bot_module, scenario))
+        r = results[scenario]
+        print('%-16s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  %9.1f req/s  peak %8.0f KiB  %7.1f KiB/req'
+              % (scenario, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['throughput_rps'], r['peak_kib'], r['alloc_kib']))
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+        print('Compared with %s:' % args.compare)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Holds up to capacity tokens and refills them at rate tokens per second.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum burst size, defaults to rate
+        :param clock: monotonic clock function, replaceable in tests
+        :param sleep: sleep function, replaceable in tests
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available.
+        :return: True if a token was taken
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one becomes available.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Empties the bucket so nothing is let through for the given time, used when Telegram asks to back off.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class DeliveryReport:
+    """
+    Result of one broadcast run.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = {}
+        self.retries = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        return "sent %s, failed %s, retries %s, took %.1fs" % (len(self.sent), len(self.failed), self.retries,
+                                                                 self.duration)
+
+
+class Broadcaster:
+    """
+    Sends one message to many chats through a bounded pool of worker threads.
+    Every send waits for the global token bucket and for the bucket of its chat, so the run stays within
+    Telegram flood limits (about 30 messages per second overall and 1 per second per chat).
+    RetryAfter pauses the global bucket for the time Telegram asked for, network errors are retried with
+    exponential backoff, and a chat that keeps failing does not stop the rest of the list.
+    """
+
+    def __init__(self, workers=8, global_rate=25, per_chat_rate=1, max_retries=3, backoff=1.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        :param workers: number of concurrent sends
+        :param global_rate: messages per second across all chats
+        :param per_chat_rate: messages per second to a single chat
+        :param max_retries: how many times a message is retried after a retryable error
+        :param backoff: first retry delay in seconds, doubled on every next retry
+        :param clock: monotonic clock function, replaceable in tests
+        :param sleep: sleep function, replaceable in tests
+        """
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._clock = clock
+        self._sleep = sleep
+        self.limiter = TokenBucket(global_rate, clock=clock, sleep=sleep)
+        self._chat_limiters = {}
+        self._chat_lock = threading.Lock()
+
+    def _chat_limiter(self, chat_id):
+        with self._chat_lock:
+            limiter = self._chat_limiters.get(chat_id)
+            if limiter is None:
+                limiter = self._chat_limiters[chat_id] = TokenBucket(self.per_chat_rate, capacity=1,
+                                                                     clock=self._clock, sleep=self._sleep)
+            return limiter
+
+    def _deliver(self, bot, chat_id, text, report, report_lock, on_delivered):
+        # A long reminder is sent as several chunks in order, the chat counts as sent once all of them went out
+        chunks = [text] if isinstance(text, str) else text
+        error = None
+        for chunk in chunks:
+            if not self._deliver_chunk(bot, chat_id, chunk, report, report_lock):
+                with report_lock:
+                    error = report.failed[chat_id]
+                break
+        else:
+            with report_lock:
+                report.sent.append(chat_id)
+        if on_delivered is not None:
+            try:
+                on_delivered(chat_id, error)
+            except Exception:
+                logger.exception("Failed to record delivery to %s", chat_id)
+
+    def _deliver_chunk(self, bot, chat_id, text, report, report_lock):
+        """
+        :return: True if the text was sent, False if the chat failed and was recorded in report.failed
+        """
+        attempt = 0
+        while True:
+            self._chat_limiter(chat_id).acquire()
+            self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                REGISTRY.inc('sdabot_send_errors_total', send='broadcast')
+                # Flood control applies to the whole bot, so every worker has to hold off
+                self.limiter.pause(e.retry_after)
+                error = e
+            except (Unauthorized, BadRequest) as e:
+                REGISTRY.inc('sdabot_send_errors_total', send='broadcast')
+                # User blocked the bot or the chat is gone, retrying won't help
+                with report_lock:
+                    report.failed[chat_id] = e
+                return False
+            except NetworkError as e:
+                REGISTRY.inc('sdabot_send_errors_total', send='broadcast')
+                self._sleep(self.backoff * 2 ** attempt)
+                error = e
+            except Exception as e:
+                logger.exception("Unexpected error while sending to %s", chat_id)
+                with report_lock:
+                    report.failed[chat_id] = e
+                return False
+            else:
+                REGISTRY.observe('sdabot_send_seconds', time.perf_counter() - started, send='broadcast')
+                return True
+            attempt += 1
+            if attempt > self.max_retries:
+                with report_lock:
+                    report.failed[chat_id] = error
+                return False
+            with report_lock:
+                report.retries += 1
+
+    def send(self, bot, messages, on_delivered=None):
+        """
+        Delivers messages and waits until all of them are sent or have failed.
+        :param bot: telegram Bot or any object with a send_message(chat_id=..., text=...) method
+        :param messages: iterable of (chat_id, text) pairs, text may be a list of chunks sent one after another
+        :param on_delivered: function (chat_id, error) called from the sending thread as soon as a chat is done,
+            error is None when the message was sent
+        :return: DeliveryReport of the run
+        """
+        report = DeliveryReport()
+        report_lock = threading.Lock()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='broadcast') as pool:
+            for chat_id, text in messages:
+                pool.submit(self._deliver, bot, chat_id, text, report, report_lock, on_delivered)
+        report.finished = time.time()
+        with self._chat_lock:
+            self._chat_limiters.clear()
+        return report
@@ -0,0 +1,167 @@
+import datetime
+import hashlib
+import hmac
+import http.server
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(text):
+    return str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    # Content lines longer than 75 octets are continued on the next line after a space (RFC 5545, 3.1)
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74
+        # Never cut inside a multi-byte character
+        while cut > 0 and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+    parts.append(data.decode('utf-8'))
+    return '\r\n '.join(parts)
+
+
+def _event(uid, day, summary, description):
+    return ['BEGIN:VEVENT',
+            'UID:%s' % uid,
+            # Stamped with the event date and not the render time, so the same data always gives the same feed and ETag
+            'DTSTAMP:%s' % day.strftime('%Y%m%dT000000Z'),
+            'DTSTART;VALUE=DATE:%s' % day.strftime('%Y%m%d'),
+            'DTEND;VALUE=DATE:%s' % (day + datetime.timedelta(days=1)).strftime('%Y%m%d'),
+            'SUMMARY:%s' % _escape(summary),
+            'DESCRIPTION:%s' % _escape(description),
+            'END:VEVENT']
+
+
+def _uid(parts, seen):
+    # Repeated rows (e.g. two "Quiz" rows of a course) are told apart by their occurrence, like deadline_diff does.
+    # The first occurrence keeps the plain key, so UIDs of calendars that are already subscribed don't change.
+    key = '|'.join(str(part) for part in parts)
+    seen[key] = seen.get(key, -1) + 1
+    if seen[key]:
+        key += '|%d' % seen[key]
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def render_calendar(name, deadlines, tasks):
+    """
+    Builds an iCalendar feed with an all-day event for every dated course deadline and personal task.
+    Event UIDs are derived from the contents, so calendar apps update events instead of duplicating them.
+    :param name: calendar name shown by calendar apps
+    :param deadlines: Deadline records, the ones without a date are skipped
+    :param tasks: Task records with ISO due dates
+    :return: feed as bytes
+    """
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//TelegramDeadlineReporter//EN', 'CALSCALE:GREGORIAN',
+             'X-WR-CALNAME:%s' % _escape(name)]
+    seen = {}
+    for deadline in deadlines:
+        # Counted before the date check, so dating a TBD row doesn't change the UIDs of the rows after it
+        uid = _uid((deadline.course, deadline.assignment), seen)
+        if deadline.date is None:
+            continue
+        lines += _event(uid + '@deadlines', deadline.date.date(), '%s: %s' % (deadline.course, deadline.assignment),
+                        'Weight: {:.0%}'.format(deadline.weight))
+    seen = {}
+    for task in tasks:
+        if not task.duedate:
+            continue
+        uid = _uid((task.description, task.duedate), seen)
+        lines += _event(uid + '@tasks', datetime.date.fromisoformat(task.duedate), task.description,
+                        'Personal task')
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(_fold(line) for line in lines) + '\r\n').encode('utf-8')
+
+
+def feed_token(secret, chat_id):
+    """
+    :return: token that makes the feed URL of a chat unguessable
+    """
+    return hmac.new(secret.encode(), str(chat_id).encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+class CalendarServer:
+    """
+    Local HTTP endpoint that serves GET /calendar/<chat_id>/<token>.ics, the deadline feed of a chat.
+    Calendar apps poll feeds every few minutes, so every reply carries an ETag and a request with a matching
+    If-None-Match gets an empty 304. Feeds come from the feed function, which is expected to cache them.
+    """
+
+    def __init__(self, feed, secret, host='127.0.0.1', port=8090, max_age=900):
+        """
+        :param feed: function chat_id -> (body, etag) of the chat's feed
+        :param secret: secret the URL tokens are made with, see feed_token
+        :param host: interface to listen on
+        :param port: port to listen on
+        :param max_age: seconds clients may keep a feed without asking again
+        """
+        server = self
+        self.feed = feed
+        self.secret = secret
+        self.max_age = max_age
+        self.counters = {'served': 0, 'not_modified': 0, 'rejected': 0}
+        self._counters_lock = threading.Lock()
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                status, headers, body = server.handle(self.path, self.headers.get('If-None-Match'))
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self._server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def handle(self, path, if_none_match=None):
+        """
+        :param path: request path
+        :param if_none_match: value of the If-None-Match header, None if missing
+        :return: (status, list of (header, value), body)
+        """
+        match = re.fullmatch(r'/calendar/(-?\d+)/([0-9a-f]{32})\.ics', path.split('?')[0])
+        if match is None or not hmac.compare_digest(match.group(2), feed_token(self.secret, int(match.group(1)))):
+            self._count('rejected')
+            return 404, [], b''
+        body, tag = self.feed(int(match.group(1)))
+        headers = [('ETag', tag), ('Cache-Control', 'private, max-age=%d' % self.max_age)]
+        if if_none_match is not None and tag in [value.strip() for value in if_none_match.split(',')]:
+            self._count('not_modified')
+            return 304, headers, b''
+        self._count('served')
+        return 200, headers + [('Content-Type', 'text/calendar; charset=utf-8')], body
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='calendar', daemon=True).start()
+        logger.info("Calendar feeds served on %s:%s", self.address[0], self.address[1])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
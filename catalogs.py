@@ -0,0 +1,110 @@
+import os
+
+from deadline_diff import diff_deadlines
+from deadline_source import DeadlineSource
+
+
+class Catalogs:
+    """
+    Deadline catalogs of all terms and cohorts served by one bot: every sheet of every configured workbook
+    is a catalog with its own DeadlineIndex. A catalog is named after its sheet, or "<workbook> / <sheet>"
+    when several workbooks have a sheet with the same name.
+    Catalogs are swapped in all at once when a workbook is reloaded, and the reload is compared with
+    the previous data, see changes.
+    """
+
+    def __init__(self, paths, default=None):
+        """
+        :param paths: paths to the Excel workbooks with deadlines
+        :param default: catalog of chats that have not chosen one, defaults to the first catalog by name
+        """
+        self.sources = [DeadlineSource(path) for path in paths]
+        self.on_reload = []
+        # What the last reload changed: {catalog name: DeadlineChanges} of the catalogs that changed,
+        # None when catalogs were added or removed and everything has to be treated as changed
+        self.changes = {}
+        self._default = default
+        self._state = None
+        self._rebuild()
+        for source in self.sources:
+            source.on_reload.append(self._source_reloaded)
+
+    def _rebuild(self):
+        counts = {}
+        for source in self.sources:
+            for sheet in source.indexes:
+                counts[sheet] = counts.get(sheet, 0) + 1
+        indexes = {}
+        for source in self.sources:
+            stem = os.path.splitext(os.path.basename(source.path))[0]
+            for sheet, index in source.indexes.items():
+                indexes[sheet if counts[sheet] == 1 else '%s / %s' % (stem, sheet)] = index
+        names = sorted(indexes)
+        if not names:
+            raise ValueError("No deadline sheets found in %s" % ', '.join(source.path for source in self.sources))
+        default = self._default if self._default in indexes else names[0]
+        # Handlers read the state as a whole, so they never see names of one load with indexes of another
+        self._state = (indexes, names, {name: number for number, name in enumerate(names)}, default)
+
+    def _source_reloaded(self, source):
+        old = self._state[0]
+        self._rebuild()
+        new = self._state[0]
+        if set(old) != set(new):
+            self.changes = None
+        else:
+            changes = {}
+            for name, index in new.items():
+                # Sheets of the other workbooks keep their index objects
+                if index is not old[name]:
+                    diff = diff_deadlines(old[name].rows, index.rows)
+                    if diff:
+                        changes[name] = diff
+            self.changes = changes
+        for callback in self.on_reload:
+            callback(self)
+
+    @property
+    def names(self):
+        """
+        Sorted catalog names.
+        """
+        return self._state[1]
+
+    @property
+    def default(self):
+        return self._state[3]
+
+    def get(self, name):
+        """
+        :return: DeadlineIndex of a catalog, the default catalog if there is no catalog with this name (anymore)
+        """
+        indexes, _, _, default = self._state
+        # Not "or": a sheet without rows yet is an empty index, but still the catalog the chat chose
+        return indexes[name] if name in indexes else indexes[default]
+
+    def resolve(self, name):
+        """
+        :return: name of the catalog get(name) returns
+        """
+        return name if name in self._state[0] else self._state[3]
+
+    def number(self, name):
+        """
+        Short id of a catalog, it fits into inline button callback data where the name may not.
+        """
+        return self._state[2][self.resolve(name)]
+
+    def by_number(self, number):
+        """
+        :return: catalog name with this number, None if there is no such catalog
+        """
+        names = self._state[1]
+        return names[number] if 0 <= number < len(names) else None
+
+    def watch(self, interval=30):
+        """
+        Starts watching all workbooks for changes, see DeadlineSource.watch.
+        """
+        for source in self.sources:
+            source.watch(interval)
@@ -0,0 +1,83 @@
+import re
+import unicodedata
+
+
+def normalize(text):
+    """
+    Lower case, accents removed, everything that is not a letter or a digit turned into single spaces.
+    """
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def trigrams(text):
+    padded = '  %s ' % text
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CourseSearch:
+    """
+    Index of course names for finding a course by what a student types, built once when the sheet is loaded.
+        - Prefix index: every prefix of every word of a name points to the courses that have it, so
+          "mach lea" finds "Machine Learning" with a few dict lookups and a set intersection.
+        - Trigram index: for typos, courses are ranked by how many letter triples they share with the query.
+    """
+
+    def __init__(self, names, min_similarity=0.3):
+        """
+        :param names: course names
+        :param min_similarity: smallest trigram similarity (0..1) of a typo match
+        """
+        self.names = list(names)
+        self.min_similarity = min_similarity
+        self._normalized = [normalize(name) for name in self.names]
+        self._exact = {}
+        self._prefixes = {}
+        self._trigrams = {}
+        self._trigram_counts = []
+        for number, name in enumerate(self._normalized):
+            self._exact.setdefault(name, number)
+            for word in set(name.split()):
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(number)
+            grams = trigrams(name)
+            self._trigram_counts.append(len(grams))
+            for gram in grams:
+                self._trigrams.setdefault(gram, []).append(number)
+
+    def search(self, query, limit=10):
+        """
+        :param query: text typed by the user, a full name, a part of it or a misspelled name
+        :param limit: maximum number of results
+        :return: course names, best match first. An exact match (ignoring case and punctuation) is returned alone.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        if query in self._exact:
+            return [self.names[self._exact[query]]]
+
+        matches = None
+        for word in query.split():
+            found = self._prefixes.get(word, set())
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+        if matches:
+            # Shorter names are closer to what was typed, sheet order breaks ties
+            ranked = sorted(matches, key=lambda number: (len(self._normalized[number]), number))
+            return [self.names[number] for number in ranked[:limit]]
+
+        grams = trigrams(query)
+        shared = {}
+        for gram in grams:
+            for number in self._trigrams.get(gram, ()):
+                shared[number] = shared.get(number, 0) + 1
+        scored = []
+        for number, count in shared.items():
+            similarity = 2.0 * count / (len(grams) + self._trigram_counts[number])
+            if similarity >= self.min_similarity:
+                scored.append((-similarity, number))
+        scored.sort()
+        return [self.names[number] for _, number in scored[:limit]]
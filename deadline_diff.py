@@ -0,0 +1,60 @@
+import collections
+
+
+class DeadlineChanges(collections.namedtuple('DeadlineChanges', 'added removed moved reweighted')):
+    """
+    Differences between two loads of a deadlines sheet, rows are matched by (Course, Assignment).
+        - added, removed: Deadline records
+        - moved, reweighted: (old, new) pairs of Deadline records whose date or weight changed,
+          a row with both changed is in both lists
+    False when nothing changed.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return any(len(part) for part in self)
+
+    @property
+    def courses(self):
+        """
+        Names of the courses with at least one changed row.
+        """
+        return ({row.course for row in self.added + self.removed}
+                | {new.course for _, new in self.moved + self.reweighted})
+
+
+def _keyed(rows):
+    # A course can have the same assignment twice (e.g. two "Quiz" rows), those are paired in sheet order
+    occurrences = {}
+    keyed = {}
+    for row in rows:
+        key = (str(row.course), str(row.assignment))
+        occurrences[key] = occurrences.get(key, -1) + 1
+        keyed[key + (occurrences[key],)] = row
+    return keyed
+
+
+def _same(a, b):
+    # Empty cells are NaN, which is not equal to itself
+    return a == b or (a != a and b != b)
+
+
+def diff_deadlines(old_rows, new_rows):
+    """
+    :param old_rows: Deadline records of the previous load
+    :param new_rows: Deadline records of the new load
+    :return: DeadlineChanges, in the order of the new sheet (removed rows in the order of the old one)
+    """
+    old, new = _keyed(old_rows), _keyed(new_rows)
+    added, moved, reweighted = [], [], []
+    for key, row in new.items():
+        before = old.get(key)
+        if before is None:
+            added.append(row)
+            continue
+        if before.date != row.date:
+            moved.append((before, row))
+        if not _same(before.weight, row.weight):
+            reweighted.append((before, row))
+    removed = [row for key, row in old.items() if key not in new]
+    return DeadlineChanges(added, removed, moved, reweighted)
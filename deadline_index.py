@@ -0,0 +1,60 @@
+import bisect
+import datetime
+
+from course_search import CourseSearch
+
+
+class DeadlineIndex:
+    """
+    In-memory index of the deadlines sheet, built once when the sheet is loaded.
+    Rows are Deadline records (see records.py), so they can be fed to prepare_output directly.
+        - by_date: rows with a known date, sorted by date. Date window queries are binary search slices over it.
+        - by_course: rows of every course in sheet order, including the ones with TBD date.
+        - search: finds courses by a part of the name or a misspelled name, see course_search.py.
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: list of Deadline records read from the deadlines sheet
+        """
+        self.rows = rows
+
+        dated = [row for row in self.rows if row.date is not None]
+        dated.sort(key=lambda row: row.date)
+        self.by_date = dated
+        self._dates = [row.date for row in dated]
+
+        self.by_course = {}
+        for row in self.rows:
+            self.by_course.setdefault(row.course, []).append(row)
+        self.courses = sorted(self.by_course)
+        # Short numeric ids of courses, they fit into inline button callback data where names may not
+        self.course_numbers = {name: number for number, name in enumerate(self.courses)}
+        self.all_by_course = [row for name in self.courses for row in self.by_course[name]]
+        self.search = CourseSearch(self.courses)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def between(self, start, end=None):
+        """
+        Returns deadlines with start <= date <= end, sorted by date.
+        :param start: lower bound of the window (datetime)
+        :param end: upper bound of the window (datetime), None means no upper bound
+        :return: list of rows
+        """
+        lo = bisect.bisect_left(self._dates, start)
+        hi = len(self._dates) if end is None else bisect.bisect_right(self._dates, end)
+        return self.by_date[lo:hi]
+
+    def upcoming(self, now=None):
+        """
+        Returns all deadlines that are yet to be due, sorted by date.
+        """
+        return self.between(now or datetime.datetime.today())
+
+    def course(self, name):
+        """
+        Returns all deadlines of a course in sheet order, empty list if there is no such course.
+        """
+        return self.by_course.get(name, [])
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+from deadline_index import DeadlineIndex
+from records import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Columns a deadline sheet starts with, sheets that don't (e.g. notes) are skipped. Only the headers the bot
+# always relied on are checked, the others are taken by position
+COLUMNS = ('Course', 'Assignment', 'Date', 'Type', 'Weight')
+CHECKED_COLUMNS = (0, 2)
+
+# Bumped whenever the snapshot contents change, older snapshots are ignored and the workbook is parsed again
+SNAPSHOT_FORMAT = 4
+
+
+def file_hash(path):
+    """
+    :param path: path to a file
+    :return: sha256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_deadlines(path, sheet_name=None):
+    """
+    Parses deadline sheets into Deadline records.
+    pandas is only imported here, a bot started from a valid snapshot never loads it.
+    :param path: path to the Excel workbook
+    :param sheet_name: sheet to read, None for all sheets of the workbook.
+        Columns are taken by position (Course, Assignment, Date, Type, Weight)
+    :return: dict {sheet name: list of Deadline records}, without sheets that are not deadline sheets
+    """
+    import pandas as pd
+
+    frames = pd.read_excel(path, sheet_name=sheet_name)
+    if sheet_name is not None:
+        frames = {sheet_name: frames}
+    sheets = {}
+    # Strings repeated on many rows and sheets (course names, types) are kept once
+    strings = {}
+    for name, frame in frames.items():
+        headers = [str(column).strip().lower() for column in frame.columns]
+        if len(headers) < len(COLUMNS) or any(headers[i] != COLUMNS[i].lower() for i in CHECKED_COLUMNS):
+            logger.warning("Skipping sheet %s of %s, it does not have the columns %s", name, path, ', '.join(COLUMNS))
+            continue
+        dates = pd.to_datetime(frame.iloc[:, 2], errors='coerce')
+        rows = []
+        for values, date in zip(frame.itertuples(index=False), dates):
+            # Blank rows come as NaN, they would break sorting and rendering of courses
+            if pd.isnull(values[0]) or pd.isnull(values[1]):
+                continue
+            course, assignment = (strings.setdefault(str(value), str(value)) for value in (values[0], values[1]))
+            kind = strings.setdefault(values[3], values[3]) if isinstance(values[3], str) else values[3]
+            rows.append(Deadline(course, assignment, None if pd.isnull(date) else date.to_pydatetime(),
+                                 kind, values[4]))
+        sheets[name] = rows
+    return sheets
+
+
+class DeadlineSource:
+    """
+    Owns a deadlines spreadsheet and the indexes built from its sheets, one per term or cohort.
+    Parsing Excel is slow, so the parsed rows are kept in a pickled snapshot next to the workbook
+    and the workbook is only parsed again when its mtime/size and then its contents change.
+    The indexes can be reloaded while the bot is running, they are swapped in as a whole so handlers
+    always see either the old or the new data, never a mix.
+    """
+
+    def __init__(self, path, sheet_name=None, snapshot_path=None):
+        """
+        :param path: path to the Excel workbook with deadlines
+        :param sheet_name: load only this sheet, None loads every sheet of the workbook
+        :param snapshot_path: where to keep the parsed snapshot, defaults to <path>.snapshot
+        """
+        self.path = path
+        self.sheet_name = sheet_name
+        self.snapshot_path = snapshot_path or path + '.snapshot'
+        self.on_reload = []
+        self._stat = None
+        self._hash = None
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop = threading.Event()
+        self.sheets = self._load()
+        self.indexes = {name: DeadlineIndex(rows) for name, rows in self.sheets.items()}
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def _write_snapshot(self, sheets, stat, digest):
+        # Write to a temporary file first so a crash never leaves a half written snapshot behind
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'format': SNAPSHOT_FORMAT, 'stat': stat, 'hash': digest, 'sheet_name': self.sheet_name,
+                         'sheets': sheets}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _load(self):
+        """
+        Returns the Deadline records of the sheets, from the snapshot if it is still valid, otherwise from the workbook.
+        The stat and hash of the workbook are only remembered once it has been loaded successfully,
+        so a workbook that failed to parse is tried again on the next check.
+        """
+        st = os.stat(self.path)
+        stat = (st.st_mtime_ns, st.st_size)
+        snapshot = self._read_snapshot()
+        if snapshot is not None and snapshot.get('format') == SNAPSHOT_FORMAT \
+                and snapshot.get('sheet_name') == self.sheet_name:
+            if snapshot['stat'] == stat:
+                digest, sheets = snapshot['hash'], snapshot['sheets']
+            else:
+                # Workbook was touched, but the contents may be the same
+                digest = file_hash(self.path)
+                sheets = snapshot['sheets'] if snapshot['hash'] == digest else None
+                if sheets is not None:
+                    self._write_snapshot(sheets, stat, digest)
+        else:
+            digest, sheets = file_hash(self.path), None
+        if sheets is None:
+            logger.info("Parsing %s, sheet %s", self.path, self.sheet_name or "(all)")
+            sheets = read_deadlines(self.path, self.sheet_name)
+            self._write_snapshot(sheets, stat, digest)
+        self._stat, self._hash = stat, digest
+        return sheets
+
+    def changed(self):
+        """
+        :return: True if the workbook has different contents than the loaded data
+        """
+        st = os.stat(self.path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._stat:
+            return False
+        if file_hash(self.path) == self._hash:
+            # Saved without changes, no need to hash it again on every check
+            self._stat = stat
+            return False
+        return True
+
+    def reload(self):
+        """
+        Loads the workbook again, swaps the indexes and notifies on_reload callbacks with this source.
+        :return: dict {sheet name: DeadlineIndex}
+        """
+        with self._lock:
+            sheets = self._load()
+            indexes = {name: DeadlineIndex(rows) for name, rows in sheets.items()}
+            self.sheets = sheets
+            self.indexes = indexes
+        logger.info("Deadlines of %s reloaded, %s rows in %s sheets", self.path,
+                    sum(len(index) for index in indexes.values()), len(indexes))
+        for callback in self.on_reload:
+            callback(self)
+        return indexes
+
+    def reload_if_changed(self):
+        """
+        :return: True if the workbook changed and the data was reloaded
+        """
+        if not self.changed():
+            return False
+        self.reload()
+        return True
+
+    def watch(self, interval=30):
+        """
+        Starts a background thread that checks the workbook every interval seconds and reloads it if needed.
+        :param interval: seconds between checks
+        """
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.reload_if_changed()
+                except Exception:
+                    # A half saved workbook fails to parse, the next check will pick it up
+                    logger.exception("Failed to reload %s", self.path)
+
+        self._stop.clear()
+        self._watcher = threading.Thread(target=loop, name='deadline-watcher', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        """
+        Stops the background watcher.
+        """
+        self._stop.set()
@@ -0,0 +1,84 @@
+import collections
+import functools
+import threading
+import time
+
+from broadcast import TokenBucket
+from metrics import REGISTRY
+
+ALLOWED = 'allowed'
+THROTTLED = 'throttled'
+DROPPED = 'dropped'
+
+
+class FloodControl:
+    """
+    Per-chat token buckets for incoming requests, so one chat spamming commands can't occupy the handler threads.
+    A chat over its limit gets one short notice (THROTTLED), everything after that is dropped without a reply
+    (DROPPED) until the bucket has a token again. Buckets of the least recently seen chats are forgotten
+    once there are more than max_chats of them.
+    """
+
+    def __init__(self, rate=1.0, burst=5, max_chats=10000, clock=time.monotonic):
+        """
+        :param rate: requests per second a chat can keep up
+        :param burst: requests a chat can send at once after being quiet
+        :param max_chats: number of chats whose buckets are kept
+        :param clock: monotonic clock function, replaceable in tests
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self._clock = clock
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, chat_id):
+        """
+        Takes a token of a chat for one request.
+        :return: ALLOWED, THROTTLED for the first rejected request since the last allowed one, DROPPED for the rest
+        """
+        with self._lock:
+            entry = self._buckets.get(chat_id)
+            if entry is None:
+                entry = self._buckets[chat_id] = [TokenBucket(self.rate, capacity=self.burst, clock=self._clock),
+                                                  False]
+                while len(self._buckets) > self.max_chats:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(chat_id)
+        bucket, notified = entry
+        if bucket.try_acquire():
+            entry[1] = False
+            return ALLOWED
+        entry[1] = True
+        return DROPPED if notified else THROTTLED
+
+
+def throttled(flood, notice):
+    """
+    Decorator for handlers that applies flood control before the handler runs.
+    A rejected update returns None, so the conversation stays in the state it was in.
+    A rejected button press is still answered, otherwise the button keeps spinning in the Telegram app.
+    :param flood: FloodControl
+    :param notice: reply sent to the chat the first time it goes over its limit
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(update, context, *args, **kwargs):
+            chat = getattr(update, 'effective_chat', None)
+            user = getattr(update, 'effective_user', None)
+            key = chat.id if chat is not None else user.id if user is not None else None
+            if key is not None:
+                verdict = flood.check(key)
+                if verdict != ALLOWED:
+                    REGISTRY.inc('sdabot_throttled_total', verdict=verdict)
+                    query = getattr(update, 'callback_query', None)
+                    if query is not None:
+                        query.answer(text=notice if verdict == THROTTLED else None)
+                    elif verdict == THROTTLED and getattr(update, 'message', None) is not None:
+                        update.message.reply_text(notice)
+                    return None
+            return function(update, context, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,58 @@
+import fcntl
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """
+    Exclusive lock on a file that only one process on the host can hold, used to have exactly one reminder worker.
+    The lock is released by the OS when the holder exits or crashes, so a waiting worker takes over at once,
+    there is no lease that has to expire first. The file holds the pid of the holder, for humans only.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: lock file, created if missing
+        """
+        self.path = path
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """
+        Tries to take the lock without waiting.
+        :return: True if this process holds the lock
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, b'%d\n' % os.getpid())
+        self._fd = fd
+        return True
+
+    def wait(self, interval=5):
+        """
+        Blocks until this process holds the lock.
+        :param interval: seconds between attempts
+        """
+        while not self.acquire():
+            time.sleep(interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
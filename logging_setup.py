@@ -0,0 +1,159 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# User and conversation step of the handler that is running, attached to every log record written meanwhile
+_log_context = contextvars.ContextVar('log_context', default={})
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds user_id, chat_id and state of the running handler to log records, None outside of handlers.
+    """
+
+    def filter(self, record):
+        context = _log_context.get()
+        record.user_id = context.get('user_id')
+        record.chat_id = context.get('chat_id')
+        record.state = context.get('state')
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes one JSON object per record, with the user and state fields set by ContextFilter.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'user_id': getattr(record, 'user_id', None),
+            'chat_id': getattr(record, 'chat_id', None),
+            'state': getattr(record, 'state', None),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RotatingLogFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Log file that is rotated at midnight and also whenever it grows over max_bytes, keeping backup_count old files.
+    Records are not flushed one by one, the background writer flushes after every batch.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=14):
+        super().__init__(filename, when='midnight', backupCount=backup_count, encoding='utf-8')
+        self.max_bytes = max_bytes
+        # Several size rollovers on one day must not overwrite each other
+        self.namer = self._unique_name
+
+    @staticmethod
+    def _unique_name(name):
+        if not os.path.exists(name):
+            return name
+        number = 1
+        while os.path.exists('%s.%d' % (name, number)):
+            number += 1
+        return '%s.%d' % (name, number)
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        return self.stream is not None and self.max_bytes > 0 and self.stream.tell() >= self.max_bytes
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that takes all queued records at once (up to batch_size), writes them and flushes once.
+    """
+
+    def __init__(self, log_queue, *handlers, batch_size=500):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+
+
+def setup_logging(filename, level=logging.INFO, json_format=False, max_bytes=10 * 1024 * 1024, backup_count=14):
+    """
+    Sends all logging through a queue to a background writer, so handlers never wait for disk I/O.
+    :param filename: log file, rotated daily and by size
+    :param level: root logging level
+    :param json_format: write the file as JSON lines with user_id, chat_id and state fields
+    :param max_bytes: size at which the log file is rotated
+    :param backup_count: number of rotated files to keep
+    :return: started listener, it is stopped and flushed at exit
+    """
+    file_handler = RotatingLogFileHandler(filename, max_bytes=max_bytes, backup_count=backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = BatchingQueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_context(function):
+    """
+    Decorator for conversation handlers: records written while the handler runs carry the id of the user,
+    the chat and the handler name as state.
+    """
+    @functools.wraps(function)
+    def wrapper(update, context, *args, **kwargs):
+        user = getattr(update, 'effective_user', None)
+        chat = getattr(update, 'effective_chat', None)
+        token = _log_context.set({'user_id': user.id if user is not None else None,
+                                  'chat_id': chat.id if chat is not None else None,
+                                  'state': function.__name__})
+        try:
+            return function(update, context, *args, **kwargs)
+        finally:
+            _log_context.reset(token)
+    return wrapper
@@ -0,0 +1,215 @@
+import bisect
+import functools
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached reply up to a full reminder mailout
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus layout.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """
+        :return: upper bound of the bucket that holds the given quantile, None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """
+    Thread-safe store of counters, histograms and gauges, keyed by metric name and a tuple of label pairs.
+    Gauges are functions that are called when metrics are rendered, e.g. the current depth of a queue.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, function, **labels):
+        """
+        Registers a gauge.
+        :param function: function without arguments that returns the current value
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.count, h.sum))
+                                for key, h in self.histograms.items())
+            gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %s' % (name, self._labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %s' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %s' % (name, self._labels(labels), count))
+        for (name, labels), function in gauges:
+            try:
+                value = function()
+            except Exception:
+                continue
+            if name not in typed:
+                lines.append('# TYPE %s gauge' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: one line with count, error count and p95 of every timed handler, storage call, send and job
+        """
+        with self._lock:
+            parts = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                label = name.replace('sdabot_', '').replace('_seconds', '')
+                if labels:
+                    label += ':' + '/'.join(str(v) for _, v in labels)
+                errors = self.counters.get((name.replace('_seconds', '_errors_total'), labels), 0)
+                parts.append('%s n=%s err=%s p95<=%ss' % (label, histogram.count, errors, histogram.quantile(0.95)))
+        return '; '.join(parts)
+
+
+REGISTRY = Registry()
+
+
+def timed(kind, name=None, registry=REGISTRY):
+    """
+    Decorator that records the latency of every call in sdabot_<kind>_seconds{<kind>="<name>"}
+    and counts calls that raised in sdabot_<kind>_errors_total.
+    :param kind: what is timed: handler, job, storage, send
+    :param name: label value, defaults to the function name
+    """
+    def decorator(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                registry.inc('sdabot_%s_errors_total' % kind, **{kind: label})
+                raise
+            finally:
+                registry.observe('sdabot_%s_seconds' % kind, time.perf_counter() - started, **{kind: label})
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint that serves GET /metrics in the Prometheus format.
+    """
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9108):
+        registry_ = registry
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry_.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self._server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def log_summaries(interval=300, registry=REGISTRY):
+    """
+    Starts a background thread that writes registry.summary() to the log every interval seconds.
+    """
+    def loop():
+        while True:
+            time.sleep(interval)
+            summary = registry.summary()
+            if summary:
+                logger.info("Metrics: %s", summary)
+
+    threading.Thread(target=loop, name='metrics-summary', daemon=True).start()
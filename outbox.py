@@ -0,0 +1,102 @@
+import datetime
+import logging
+import threading
+import time
+
+from broadcast import DeliveryReport
+from paging import split_text
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Durable queue of reminder messages in an SQLite table, see OUTBOX_MIGRATIONS in storage.py.
+    Generating a mailout only writes rows, delivery drains them in batches and marks every message as soon as
+    it is sent, so a restart continues where the previous run stopped instead of starting over.
+    Messages are unique per (chat_id, reminder_date, kind), running a reminder job twice never sends twice.
+    A message that was being sent at the moment of a crash is the only one that can go out again.
+    """
+
+    def __init__(self, db, batch_size=500, keep_days=30):
+        """
+        :param db: Database with the outbox table
+        :param batch_size: messages handed to the broadcaster at once
+        :param keep_days: delivered and failed messages older than this are deleted after a drain
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.keep_days = keep_days
+        self._drain_lock = threading.Lock()
+
+    def enqueue(self, kind, reminder_date, messages):
+        """
+        Stores the messages of one mailout in a single transaction, messages that are already there are skipped.
+        :param kind: reminder type, e.g. 'daily' or 'weekly'
+        :param reminder_date: datetime.date the mailout belongs to, a datetime for mailouts that can happen
+            several times a day (e.g. deadline change notices)
+        :param messages: iterable of (chat_id, text) pairs
+        :return: number of new messages
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        rows = [(chat_id, reminder_date.isoformat(), kind, text, now) for chat_id, text in messages]
+        with self.db.write() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO outbox (chat_id, reminder_date, kind, text, created_at) "
+                                   "VALUES (?,?,?,?,?)", rows)
+            return connection.total_changes - before
+
+    def pending(self):
+        """
+        :return: next batch of (chat_id, reminder_date, kind, text) messages to send.
+            A batch belongs to one mailout, so every chat is in it only once.
+        """
+        return self.db.query("SELECT chat_id, reminder_date, kind, text FROM outbox WHERE status = 'pending' "
+                             "AND (reminder_date, kind) = (SELECT reminder_date, kind FROM outbox "
+                             "WHERE status = 'pending' ORDER BY reminder_date, kind LIMIT 1) LIMIT ?",
+                             (self.batch_size,))
+
+    def _mark(self, reminder_date, kind, chat_id, error):
+        if error is None:
+            self.db.execute("UPDATE outbox SET status = 'sent', sent_at = ? "
+                            "WHERE chat_id = ? AND reminder_date = ? AND kind = ?",
+                            (datetime.datetime.now().isoformat(timespec='seconds'), chat_id, reminder_date, kind))
+        else:
+            self.db.execute("UPDATE outbox SET status = 'failed', error = ? "
+                            "WHERE chat_id = ? AND reminder_date = ? AND kind = ?",
+                            (repr(error), chat_id, reminder_date, kind))
+
+    def drain(self, bot, broadcaster):
+        """
+        Sends everything that is pending, batch by batch, until the outbox is empty.
+        Only one drain runs at a time, a second caller waits and then finds nothing left to send.
+        :param bot: telegram Bot
+        :param broadcaster: Broadcaster that does the rate limited sending
+        :return: DeliveryReport over all batches
+        """
+        total = DeliveryReport()
+        attempted = set()
+        with self._drain_lock:
+            while True:
+                batch = [row for row in self.pending() if row[:3] not in attempted]
+                if not batch:
+                    # Either all sent, or the rows that are left could not be marked, they are retried on the next drain
+                    break
+                attempted.update(row[:3] for row in batch)
+                reminder_date, kind = batch[0][1], batch[0][2]
+                report = broadcaster.send(
+                    bot, [(chat_id, list(split_text(text))) for chat_id, _, _, text in batch],
+                    on_delivered=lambda chat_id, error: self._mark(reminder_date, kind, chat_id, error))
+                total.sent.extend(report.sent)
+                total.failed.update(report.failed)
+                total.retries += report.retries
+            self.purge()
+        total.finished = time.time()
+        return total
+
+    def purge(self):
+        """
+        Deletes delivered and failed messages older than keep_days, so the table stays small.
+        """
+        cutoff = (datetime.date.today() - datetime.timedelta(days=self.keep_days)).isoformat()
+        self.db.execute("DELETE FROM outbox WHERE status != 'pending' AND reminder_date < ?", (cutoff,))
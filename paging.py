@@ -0,0 +1,44 @@
+# Telegram rejects messages longer than this many characters
+MESSAGE_LIMIT = 4096
+
+
+def take_page(rows, render, start=0, limit=MESSAGE_LIMIT):
+    """
+    Renders rows into one message, starting at a cursor and stopping on a record boundary before the limit.
+    Only the rows that end up on the page are rendered, so the first page of a long list is as cheap as any other.
+    :param rows: sequence of records
+    :param render: function that turns one record into its text
+    :param start: index of the first row of the page
+    :param limit: maximum length of the page
+    :return: (text, next_start), next_start is None on the last page
+    """
+    parts = []
+    length = 0
+    position = start
+    while position < len(rows):
+        piece = render(rows[position])
+        if parts and length + len(piece) > limit:
+            return "".join(parts), position
+        if len(piece) > limit:
+            # A single record that does not fit at all is cut, otherwise it could never be sent
+            piece = piece[:limit]
+        parts.append(piece)
+        length += len(piece)
+        position += 1
+    return "".join(parts), None
+
+
+def split_text(text, limit=MESSAGE_LIMIT, separator="\n\n"):
+    """
+    Generator that splits an already rendered text into message-sized chunks, preferably between records.
+    :param text: text to split
+    :param limit: maximum length of a chunk
+    :param separator: records are separated by it, chunks are cut right after it when possible
+    """
+    while len(text) > limit:
+        cut = text.rfind(separator, 0, limit - len(separator) + 1)
+        cut = limit if cut <= 0 else cut + len(separator)
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
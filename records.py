@@ -0,0 +1,17 @@
+import collections
+
+
+class Deadline(collections.namedtuple('Deadline', 'course assignment date kind weight')):
+    """
+    One row of the deadlines sheet, in the same column order as the sheet (Course, Assignment, Date, Type, Weight).
+    A plain tuple without a per-row __dict__, so the whole term fits in a few hundred KiB and pickles fast.
+    date is a datetime, None when the sheet says TBD or anything else that is not a date.
+    """
+    __slots__ = ()
+
+
+class Task(collections.namedtuple('Task', 'description duedate')):
+    """
+    Personal task as read from the tasks table, duedate is an ISO date string.
+    """
+    __slots__ = ()
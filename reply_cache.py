@@ -0,0 +1,116 @@
+import collections
+import datetime
+import threading
+
+
+class ReplyCache:
+    """
+    Bounded LRU cache of rendered bot replies that are the same for every user (course-wide views).
+    Entries belong to the current date bucket: the whole cache is dropped when the date rolls over,
+    because "upcoming" and "by next Sunday" views depend on today's date.
+    It also has to be cleared explicitly when the deadline source is reloaded.
+    Concurrent misses of the same view are coalesced: one caller renders, the others wait for its text.
+    """
+
+    def __init__(self, maxsize=256):
+        """
+        :param maxsize: maximum number of rendered replies kept at once
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = collections.OrderedDict()
+        self._day = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        # view -> (event set when rendered, [text or exception]) of renders in progress
+        self._rendering = {}
+
+    def get(self, view, render, today=None):
+        """
+        Returns the cached reply for a view, rendering and storing it on a miss.
+        :param view: hashable key of the view, e.g. ('deadlines', 1) or ('course', 'Statistics')
+        :param render: function without arguments that builds the reply text
+        :param today: date bucket of the request, defaults to the current date
+        :return: rendered reply text
+        """
+        today = today or datetime.date.today()
+        with self._lock:
+            if today != self._day:
+                self._entries.clear()
+                self._generation += 1
+                self._day = today
+            if view in self._entries:
+                self._entries.move_to_end(view)
+                self.hits += 1
+                return self._entries[view]
+            rendering = self._rendering.get(view)
+            if rendering is None:
+                rendering = self._rendering[view] = (threading.Event(), [])
+                self.misses += 1
+                generation = self._generation
+            else:
+                self.coalesced += 1
+                generation = None
+        event, result = rendering
+        if generation is None:
+            event.wait()
+            if isinstance(result[0], Exception):
+                raise result[0]
+            return result[0]
+        try:
+            text = render()
+        except Exception as e:
+            result.append(e)
+            raise
+        else:
+            result.append(text)
+        finally:
+            with self._lock:
+                del self._rendering[view]
+                # Skip storing if the cache was cleared while rendering, the text may be stale already
+                if result and not isinstance(result[0], Exception) and self._generation == generation:
+                    self._entries[view] = text
+                    self._entries.move_to_end(view)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+            event.set()
+        return text
+
+    def clear(self):
+        """
+        Drops all rendered replies, called when the deadline source is reloaded.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def discard(self, view):
+        """
+        Drops the rendered reply of one view, e.g. when data only this view depends on has changed.
+        """
+        with self._lock:
+            self._entries.pop(view, None)
+            # A render of the view that is in progress may already hold the old data, it must not be stored
+            self._generation += 1
+
+    def discard_if(self, predicate):
+        """
+        Drops the rendered replies of all views the predicate is true for, e.g. the views of courses that changed.
+        :param predicate: function view -> bool
+        :return: number of dropped replies
+        """
+        with self._lock:
+            stale = [view for view in self._entries if predicate(view)]
+            for view in stale:
+                del self._entries[view]
+            self._generation += 1
+        return len(stale)
+
+    def stats(self):
+        """
+        :return: dict with hit/miss/coalesced counters and current size
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self._entries)}
@@ -0,0 +1,217 @@
+import datetime
+import heapq
+import logging
+import re
+import threading
+import time
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# Reminder types: the subscriptions column that switches them on, weekdays they are sent on and the time
+# they are sent at when the user did not pick one
+REMINDERS = {
+    'daily': {'column': 'upcoming', 'days': tuple(range(7)), 'time': datetime.time(10, 8)},
+    'weekly': {'column': 'weekly', 'days': (6,), 'time': datetime.time(19, 0)},
+}
+DEFAULT_TIMEZONE = 'CET'
+
+
+def parse_reminder_time(text):
+    """
+    Reads the reminder time a user typed, e.g. "18:30" or "18:30 Europe/Berlin".
+    :return: (time as HH:MM string, timezone name or None), None if the text can't be read
+    """
+    match = re.fullmatch(r'\s*(\d{1,2})[:.](\d{2})(?:\s+(\S+))?\s*', text)
+    if match is None:
+        return None
+    hour, minute, timezone = int(match.group(1)), int(match.group(2)), match.group(3)
+    if hour > 23 or minute > 59:
+        return None
+    if timezone is not None:
+        # Time zone names are case sensitive in pytz, but nobody types them like that
+        names = {name.lower(): name for name in pytz.all_timezones}
+        timezone = names.get(timezone.lower())
+        if timezone is None:
+            return None
+    return '%02d:%02d' % (hour, minute), timezone
+
+
+def next_run(kind, remind_time, timezone, now):
+    """
+    :param kind: reminder type, key of REMINDERS
+    :param remind_time: HH:MM string in the user's time zone, None for the default time of the reminder
+    :param timezone: pytz time zone name
+    :param now: timezone aware datetime
+    :return: (aware UTC datetime of the next reminder after now, local date of that reminder)
+    """
+    tz = pytz.timezone(timezone)
+    at = datetime.time(*map(int, remind_time.split(':'))) if remind_time else REMINDERS[kind]['time']
+    day = now.astimezone(tz).date()
+    while True:
+        if day.weekday() in REMINDERS[kind]['days']:
+            due = tz.localize(datetime.datetime.combine(day, at)).astimezone(pytz.utc)
+            if due > now:
+                return due, day
+        day += datetime.timedelta(days=1)
+
+
+class ReminderScheduler:
+    """
+    Single scheduler for the reminders of all subscribers, instead of a JobQueue entry per user.
+    Every subscribed (chat, reminder type) pair has one entry in a heap ordered by the time it is due.
+    The scheduler thread sleeps until the earliest entry, takes everything that is due at that moment
+    (users who picked the same minute) and hands it to deliver in one batch per reminder type and local date.
+    Settings are kept in memory, a change pushes a new entry and the old one is skipped when it comes up.
+    """
+
+    def __init__(self, deliver=None, clock=time.time):
+        """
+        :param deliver: function (kind, reminder_date, chat_ids) that sends one batch of reminders
+        :param clock: function that returns the current unix time, replaceable in tests
+        """
+        self.deliver = deliver
+        self._clock = clock
+        self._settings = {}
+        self._versions = {}
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def _now(self):
+        return datetime.datetime.fromtimestamp(self._clock(), pytz.utc)
+
+    def _push(self, chat_id, now):
+        settings = self._settings[chat_id]
+        version = self._versions[chat_id]
+        for kind, reminder in REMINDERS.items():
+            if settings[reminder['column']]:
+                due, day = next_run(kind, settings['remind_time'], settings['timezone'], now)
+                heapq.heappush(self._heap, (due, chat_id, kind, day, version))
+
+    def set(self, chat_id, **changes):
+        """
+        Updates the settings of a chat and reschedules its reminders.
+        :param changes: any of upcoming, weekly (0 or 1), remind_time (HH:MM or None), timezone
+        """
+        with self._lock:
+            settings = self._settings.setdefault(chat_id, {'upcoming': 0, 'weekly': 0, 'remind_time': None,
+                                                           'timezone': DEFAULT_TIMEZONE})
+            settings.update(changes)
+            if not settings['timezone']:
+                settings['timezone'] = DEFAULT_TIMEZONE
+            self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+            self._push(chat_id, self._now())
+        self._wakeup.set()
+
+    def remove(self, chat_id):
+        """
+        Stops all reminders of a chat.
+        """
+        with self._lock:
+            self._settings.pop(chat_id, None)
+            # The entries stay in the heap, the version makes them stale
+            self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+        self._wakeup.set()
+
+    def load(self, rows):
+        """
+        Replaces all settings, e.g. with the contents of the subscriptions table.
+        :param rows: (chat_id, upcoming, weekly, remind_time, timezone) rows
+        """
+        now = self._now()
+        with self._lock:
+            self._settings = {}
+            self._heap = []
+            for chat_id, upcoming, weekly, remind_time, timezone in rows:
+                self._settings[chat_id] = {'upcoming': upcoming, 'weekly': weekly, 'remind_time': remind_time,
+                                           'timezone': timezone or DEFAULT_TIMEZONE}
+                self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+                self._push(chat_id, now)
+        self._wakeup.set()
+
+    def sync(self, rows):
+        """
+        Brings the settings in line with rows, e.g. with the subscriptions table changed by another process.
+        Unlike load, chats whose settings are the same keep their entries, so a reminder that is just coming due
+        is not rescheduled past its time.
+        :param rows: (chat_id, upcoming, weekly, remind_time, timezone) rows
+        :return: number of chats whose reminders changed
+        """
+        wanted = {chat_id: {'upcoming': upcoming, 'weekly': weekly, 'remind_time': remind_time,
+                            'timezone': timezone or DEFAULT_TIMEZONE}
+                  for chat_id, upcoming, weekly, remind_time, timezone in rows}
+        with self._lock:
+            current = {chat_id: dict(settings) for chat_id, settings in self._settings.items()}
+        for chat_id in current.keys() - wanted.keys():
+            self.remove(chat_id)
+        changed = [chat_id for chat_id, settings in wanted.items() if current.get(chat_id) != settings]
+        for chat_id in changed:
+            self.set(chat_id, **wanted[chat_id])
+        return len(changed) + len(current.keys() - wanted.keys())
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_due(self):
+        """
+        :return: aware UTC datetime of the earliest entry, None if nothing is scheduled
+        """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def take_due(self, now=None):
+        """
+        Pops everything that is due and schedules the next reminder of every popped chat.
+        :return: dict {(kind, reminder_date): [chat_id, ...]}
+        """
+        now = now or self._now()
+        batches = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, chat_id, kind, day, version = heapq.heappop(self._heap)
+                if self._versions.get(chat_id) != version:
+                    continue
+                batches.setdefault((kind, day), []).append(chat_id)
+                settings = self._settings[chat_id]
+                due, day = next_run(kind, settings['remind_time'], settings['timezone'], now)
+                heapq.heappush(self._heap, (due, chat_id, kind, day, version))
+        return batches
+
+    def run_pending(self, now=None):
+        """
+        Delivers everything that is due.
+        :return: number of reminders handed to deliver
+        """
+        count = 0
+        for (kind, day), chat_ids in sorted(self.take_due(now).items()):
+            count += len(chat_ids)
+            try:
+                self.deliver(kind, day, chat_ids)
+            except Exception:
+                logger.exception("Failed to deliver %s reminders of %s to %s chats", kind, day, len(chat_ids))
+        return count
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        def loop():
+            while not self._stop.is_set():
+                due = self.next_due()
+                wait = 60 if due is None else (due - self._now()).total_seconds()
+                # Woken up early whenever settings change, the new entry may be due sooner
+                if wait > 0 and self._wakeup.wait(min(wait, 60)):
+                    self._wakeup.clear()
+                    continue
+                self._wakeup.clear()
+                self.run_pending()
+
+        self._stop.clear()
+        threading.Thread(target=loop, name='reminders', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
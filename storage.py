@@ -0,0 +1,280 @@
+import contextlib
+import contextvars
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Format users type dates in, dates are stored as ISO yyyy-mm-dd so SQLite can compare and sort them
+USER_DATE_FORMAT = "%d/%m/%Y"
+
+# Applied to every connection. WAL lets the reminder jobs read whole tables while handlers write,
+# busy_timeout makes a writer from another process wait for the lock instead of failing right away.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+# Set while a handler runs in asyncio mode, writes are collected here instead of being executed, see deferred_writes()
+_deferred = contextvars.ContextVar('deferred_writes', default=None)
+
+
+class Database:
+    """
+    Storage layer for one SQLite file that is shared by the dispatcher worker threads and the JobQueue thread.
+        - Reads borrow a connection from a small pool, so readers don't wait on each other up to the pool size.
+          Connections are not tied to threads, short-lived threads (e.g. of an HTTP server) don't leave any behind.
+        - Writes go through a single writer connection guarded by a lock, so they are serialized
+          inside the process and do not fight for the database lock. Thanks to WAL they don't block reads.
+    """
+
+    def __init__(self, path, timeout=30, readers=8):
+        """
+        :param path: path to the SQLite database file
+        :param timeout: seconds to wait for the database lock held by another process
+        :param readers: maximum number of read connections, more concurrent readers wait for a free one
+        """
+        self.path = path
+        self.timeout = timeout
+        self.readers = readers
+        self._idle = queue.LifoQueue()
+        self._opened_readers = 0
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def read(self):
+        """
+        Context manager that borrows a read connection from the pool and gives it back afterwards.
+        """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._connections_lock:
+                open_new = self._opened_readers < self.readers
+                if open_new:
+                    self._opened_readers += 1
+            connection = self._connect() if open_new else self._idle.get()
+        try:
+            yield connection
+        finally:
+            # Ends the implicit read transaction so the WAL can be checkpointed
+            connection.rollback()
+            self._idle.put(connection)
+
+    @contextlib.contextmanager
+    def write(self):
+        """
+        Context manager that gives the writer connection inside a transaction.
+        Commits when the block succeeds and rolls back if it raises.
+        """
+        started = time.perf_counter()
+        with self._write_lock:
+            REGISTRY.observe('sdabot_storage_lock_wait_seconds', time.perf_counter() - started, database=self.path)
+            with self._writer:
+                yield self._writer
+
+    def query(self, sql, params=()):
+        """
+        Runs a SELECT statement.
+        :return: list of fetched rows
+        """
+        started = time.perf_counter()
+        try:
+            with self.read() as connection:
+                return connection.execute(sql, params).fetchall()
+        finally:
+            REGISTRY.observe('sdabot_storage_seconds', time.perf_counter() - started, database=self.path,
+                             operation='query')
+
+    def execute(self, sql, params=()):
+        """
+        Runs a single write statement in its own transaction.
+        Inside deferred_writes() the statement is only queued and None is returned.
+        :return: number of affected rows
+        """
+        pending = _deferred.get()
+        if pending is not None:
+            pending.append((self, sql, params))
+            return None
+        started = time.perf_counter()
+        try:
+            with self.write() as connection:
+                return connection.execute(sql, params).rowcount
+        finally:
+            REGISTRY.observe('sdabot_storage_seconds', time.perf_counter() - started, database=self.path,
+                             operation='execute')
+
+    def executemany(self, sql, rows):
+        """
+        Runs a write statement for every row, all in one transaction.
+        Inside deferred_writes() the statements are only queued (flush_writes applies them in one transaction too)
+        and None is returned.
+        :return: number of affected rows
+        """
+        rows = list(rows)
+        pending = _deferred.get()
+        if pending is not None:
+            pending.extend((self, sql, params) for params in rows)
+            return None
+        started = time.perf_counter()
+        try:
+            with self.write() as connection:
+                return connection.executemany(sql, rows).rowcount
+        finally:
+            REGISTRY.observe('sdabot_storage_seconds', time.perf_counter() - started, database=self.path,
+                             operation='executemany')
+
+    def close(self):
+        """
+        Closes all connections opened by this database.
+        """
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._idle = queue.LifoQueue()
+            self._opened_readers = 0
+
+
+@contextlib.contextmanager
+def deferred_writes():
+    """
+    Context manager that collects Database.execute() calls made inside it instead of running them.
+    Used by the asyncio runtime so a handler never waits for the write lock on the event loop,
+    the collected writes are then applied with flush_writes() in a worker thread.
+    :return: list that receives (database, sql, params) entries
+    """
+    writes = []
+    token = _deferred.set(writes)
+    try:
+        yield writes
+    finally:
+        _deferred.reset(token)
+
+
+def flush_writes(writes):
+    """
+    Applies writes collected by deferred_writes(), one transaction per database.
+    :param writes: list of (database, sql, params) entries
+    """
+    by_database = {}
+    for db, sql, params in writes:
+        by_database.setdefault(db, []).append((sql, params))
+    for db, statements in by_database.items():
+        with db.write() as connection:
+            for sql, params in statements:
+                connection.execute(sql, params)
+
+
+def parse_user_date(text):
+    """
+    Converts a date typed by a user into the stored form.
+    :param text: date in format dd/mm/yyyy
+    :return: date as yyyy-mm-dd string, None if the text is not a valid date
+    """
+    try:
+        return datetime.datetime.strptime(text.strip(), USER_DATE_FORMAT).date().isoformat()
+    except ValueError:
+        return None
+
+
+def migrate(db, migrations):
+    """
+    Brings the schema of a database up to date.
+    The number of applied migrations is kept in PRAGMA user_version, so every migration runs exactly once.
+    :param db: Database to migrate
+    :param migrations: list of functions that take a connection, in the order they have to be applied
+    """
+    with db.write() as connection:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            logger.info("Applying migration %s of %s", number, db.path)
+            migration(connection)
+            connection.execute("PRAGMA user_version = %d" % number)
+
+
+def _tasks_iso_dates(connection):
+    # Tasks were stored with dd/mm/yyyy dates that can't be range filtered, rewrite them as yyyy-mm-dd.
+    # Dates that can't be read (the edit dialog used to take any text) are kept in duedate_raw, so users can fix them
+    connection.execute("CREATE TABLE IF NOT EXISTS tasks (username TEXT, chat_id INTEGER, description TEXT, duedate TEXT)")
+    connection.execute("ALTER TABLE tasks ADD COLUMN duedate_raw TEXT")
+    rows = connection.execute("SELECT rowid, duedate FROM tasks").fetchall()
+    for rowid, duedate in rows:
+        iso_date = parse_user_date(str(duedate))
+        if iso_date is None:
+            logger.warning("Task %s has invalid due date %r, it is kept until the user changes it", rowid, duedate)
+        connection.execute("UPDATE tasks SET duedate = ?, duedate_raw = ? WHERE rowid = ?",
+                           (iso_date, duedate if iso_date is None else None, rowid))
+    connection.execute("CREATE INDEX IF NOT EXISTS tasks_chat_id_duedate ON tasks (chat_id, duedate)")
+    connection.execute("CREATE INDEX IF NOT EXISTS tasks_username ON tasks (username, duedate)")
+
+
+def _tasks_raw_dates(connection):
+    # Databases migrated before _tasks_iso_dates kept unreadable dates have no duedate_raw column yet
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(tasks)")]
+    if 'duedate_raw' not in columns:
+        connection.execute("ALTER TABLE tasks ADD COLUMN duedate_raw TEXT")
+
+
+TASKS_MIGRATIONS = [_tasks_iso_dates, _tasks_raw_dates]
+
+
+def _subscriptions_one_per_chat(connection):
+    # Every settings change used to insert another row, keep only the latest row of every chat
+    connection.execute("CREATE TABLE IF NOT EXISTS subscriptions (username TEXT, chat_id INTEGER, upcoming INTEGER, "
+                       "weekly INTEGER)")
+    removed = connection.execute("DELETE FROM subscriptions WHERE rowid NOT IN "
+                                 "(SELECT MAX(rowid) FROM subscriptions GROUP BY chat_id)").rowcount
+    if removed:
+        logger.info("Removed %s outdated subscription rows", removed)
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS subscriptions_chat_id ON subscriptions (chat_id)")
+    # Partial indexes hold the recipients of each reminder, SQLite keeps them up to date on every upsert
+    connection.execute("CREATE INDEX IF NOT EXISTS subscriptions_upcoming ON subscriptions (chat_id) WHERE upcoming = 1")
+    connection.execute("CREATE INDEX IF NOT EXISTS subscriptions_weekly ON subscriptions (chat_id) WHERE weekly = 1")
+
+
+def _subscriptions_reminder_time(connection):
+    # Time of day (HH:MM, NULL for the default time of each reminder) and time zone picked by the user
+    connection.execute("ALTER TABLE subscriptions ADD COLUMN remind_time TEXT")
+    connection.execute("ALTER TABLE subscriptions ADD COLUMN timezone TEXT")
+
+
+def _chat_catalogs(connection):
+    # Term or cohort chosen by a chat, chats without a row use the default catalog
+    connection.execute("CREATE TABLE IF NOT EXISTS chat_catalogs (chat_id INTEGER PRIMARY KEY, catalog TEXT NOT NULL)")
+
+
+SUBSCRIPTIONS_MIGRATIONS = [_subscriptions_one_per_chat, _subscriptions_reminder_time, _chat_catalogs]
+
+
+def _outbox_table(connection):
+    # One row per reminder message, the unique key makes generating the same mailout twice a no-op
+    connection.execute("CREATE TABLE IF NOT EXISTS outbox (chat_id INTEGER NOT NULL, reminder_date TEXT NOT NULL, "
+                       "kind TEXT NOT NULL, text TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', "
+                       "error TEXT, created_at TEXT NOT NULL, sent_at TEXT, "
+                       "UNIQUE (chat_id, reminder_date, kind))")
+    connection.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (reminder_date, kind) "
+                       "WHERE status = 'pending'")
+
+
+OUTBOX_MIGRATIONS = [_outbox_table]
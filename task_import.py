@@ -0,0 +1,84 @@
+import csv
+import datetime
+import io
+import os
+import re
+
+from storage import parse_user_date
+
+EXTENSIONS = ('.csv', '.xlsx', '.xls')
+# Files larger than this are refused before they are downloaded
+MAX_FILE_SIZE = 1024 * 1024
+MAX_ROWS = 1000
+
+
+def _csv_rows(data):
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("the file is not UTF-8 text")
+    # Spreadsheet apps export with ";" in many locales, so the delimiter is guessed
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+
+def _excel_rows(data):
+    import pandas as pd
+
+    try:
+        frame = pd.read_excel(io.BytesIO(data), header=None, dtype=object)
+    except Exception as e:
+        raise ValueError("the spreadsheet can't be read (%s)" % e)
+    return [[None if pd.isnull(value) else value for value in row] for row in frame.itertuples(index=False)]
+
+
+def _date(value):
+    # Spreadsheet cells formatted as dates come as datetimes, everything else is read like a typed date
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return parse_user_date(str(value)) if value is not None else None
+
+
+def parse_tasks(filename, data):
+    """
+    Reads personal tasks from an uploaded file, one task per row: description in the first column and
+    the due date (dd/mm/yyyy, or a date cell in a spreadsheet) in the second. A header row is skipped,
+    a first row with a wrong date is reported like any other.
+    :param filename: name of the uploaded file, its extension picks the format
+    :param data: file contents as bytes
+    :return: ([(description, due date as yyyy-mm-dd), ...], [(row number, error), ...])
+    :raises ValueError: if the file can't be read at all
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError("only %s files are supported" % ', '.join(EXTENSIONS))
+    rows = _csv_rows(data) if extension == '.csv' else _excel_rows(data)
+
+    tasks, errors = [], []
+    for number, row in enumerate(rows, start=1):
+        cells = [value.strip() if isinstance(value, str) else value for value in row]
+        if all(value in (None, '') for value in cells):
+            continue
+        if len(tasks) >= MAX_ROWS:
+            errors.append((number, "only the first %d tasks of a file are added" % MAX_ROWS))
+            break
+        description = str(cells[0]) if cells[0] not in (None, '') else ''
+        value = cells[1] if len(cells) > 1 else None
+        duedate = _date(value)
+        if duedate is None and not tasks and not errors and not re.search(r'\d', str(value or '')):
+            # First filled row with no digits where the date should be, a header like "Task;Deadline"
+            continue
+        if not description:
+            errors.append((number, "no task description"))
+        elif value in (None, ''):
+            errors.append((number, "no deadline"))
+        elif duedate is None:
+            errors.append((number, "can't read the date %r, use dd/mm/yyyy" % str(value)))
+        else:
+            tasks.append((description, duedate))
+    return tasks, errors
@@ -0,0 +1,39 @@
+import threading
+
+
+class FakeClock:
+    """
+    Time that only moves when something sleeps, so rate limits and backoff run instantly.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += max(seconds, 0)
+
+
+class FakeBot:
+    """
+    Records sent messages, a chat can be set to raise a list of errors on its next sends.
+    """
+
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        with self._lock:
+            errors = self.failures.get(chat_id)
+            if errors:
+                raise errors.pop(0)
+            self.sent.append((chat_id, text))
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import NetworkError, RetryAfter, Unauthorized
+
+from broadcast import Broadcaster, TokenBucket
+from fakes import FakeBot, FakeClock
+
+
+def broadcaster(clock, **kwargs):
+    return Broadcaster(workers=1, global_rate=25, per_chat_rate=1, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_sends_every_message_and_chunks_in_order():
+    clock = FakeClock()
+    bot = FakeBot()
+    report = broadcaster(clock).send(bot, [(1, 'one'), (2, ['two a', 'two b']), (3, 'three')])
+    assert sorted(report.sent) == [1, 2, 3]
+    assert report.failed == {}
+    assert report.retries == 0
+    assert [text for chat_id, text in bot.sent if chat_id == 2] == ['two a', 'two b']
+
+
+def test_retry_after_pauses_sending_and_retries():
+    clock = FakeClock()
+    bot = FakeBot({1: [RetryAfter(5)]})
+    report = broadcaster(clock).send(bot, [(1, 'hello')])
+    assert report.sent == [1]
+    assert report.retries == 1
+    assert bot.sent == [(1, 'hello')]
+    # The retry waited for the time Telegram asked for
+    assert clock.now >= 5
+
+
+def test_network_errors_are_retried_with_exponential_backoff():
+    clock = FakeClock()
+    bot = FakeBot({1: [NetworkError('timed out'), NetworkError('timed out')]})
+    report = broadcaster(clock, backoff=1.0).send(bot, [(1, 'hello')])
+    assert report.sent == [1]
+    assert report.retries == 2
+    assert 1.0 in clock.sleeps and 2.0 in clock.sleeps
+
+
+def test_chat_that_keeps_failing_is_reported_and_others_are_sent():
+    clock = FakeClock()
+    bot = FakeBot({1: [NetworkError('down')] * 10})
+    delivered = {}
+    report = broadcaster(clock, max_retries=2).send(
+        bot, [(1, 'hello'), (2, 'hello')], on_delivered=lambda chat_id, error: delivered.update({chat_id: error}))
+    assert report.sent == [2]
+    assert isinstance(report.failed[1], NetworkError)
+    assert report.retries == 2
+    assert delivered[2] is None
+    assert delivered[1] is report.failed[1]
+
+
+def test_blocked_chat_is_not_retried():
+    clock = FakeClock()
+    bot = FakeBot({1: [Unauthorized('blocked'), Unauthorized('blocked')]})
+    report = broadcaster(clock).send(bot, [(1, 'hello')])
+    assert isinstance(report.failed[1], Unauthorized)
+    assert report.retries == 0
+    assert len(bot.failures[1]) == 1
+
+
+def test_token_bucket_waits_for_tokens():
+    clock = FakeClock()
+    bucket = TokenBucket(2, capacity=2, clock=clock, sleep=clock.sleep)
+    for _ in range(4):
+        bucket.acquire()
+    # Two tokens at once, then one every half a second
+    assert clock.now == pytest.approx(1.0)
+    assert not bucket.try_acquire()
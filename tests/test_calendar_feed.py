@@ -0,0 +1,28 @@
+import datetime
+import re
+
+from calendar_feed import render_calendar
+from records import Deadline, Task
+
+
+def uids(body):
+    return re.findall(r'^UID:(\S+)\r$', body.decode(), flags=re.M)
+
+
+def test_repeated_rows_get_distinct_stable_uids():
+    quiz = [Deadline('Stats', 'Quiz', datetime.datetime(2026, 11, day), 'Quiz', 0.1) for day in (2, 9)]
+    body = render_calendar('Term', quiz, [Task('Read', '2026-11-03'), Task('Read', '2026-11-03')])
+    found = uids(body)
+    assert len(found) == 4
+    assert len(set(found)) == 4
+    # Same data, same feed
+    assert render_calendar('Term', quiz, [Task('Read', '2026-11-03'), Task('Read', '2026-11-03')]) == body
+
+
+def test_dating_a_tbd_row_keeps_other_uids():
+    undated = [Deadline('Stats', 'Quiz', None, 'Quiz', 0.1),
+               Deadline('Stats', 'Quiz', datetime.datetime(2026, 11, 9), 'Quiz', 0.1)]
+    dated = [undated[0]._replace(date=datetime.datetime(2026, 11, 2)), undated[1]]
+    before, after = uids(render_calendar('Term', undated, [])), uids(render_calendar('Term', dated, []))
+    assert len(before) == 1
+    assert before[0] == after[1]
@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip('telegram')
+
+from flood import ALLOWED, DROPPED, THROTTLED, FloodControl, throttled
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Recorder:
+    """
+    Stands in for a Message or CallbackQuery and records what the handler wrapper sent.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def reply_text(self, text):
+        self.calls.append(('reply_text', text))
+
+    def answer(self, text=None):
+        self.calls.append(('answer', text))
+
+
+class Chat:
+    id = 7
+
+
+class FakeUpdate:
+    def __init__(self, message=None, callback_query=None):
+        self.effective_chat = Chat()
+        self.effective_user = None
+        self.message = message
+        self.callback_query = callback_query
+
+
+def test_burst_then_notice_once_then_drop():
+    clock = Clock()
+    flood = FloodControl(rate=1, burst=2, clock=clock)
+    assert [flood.check(1) for _ in range(4)] == [ALLOWED, ALLOWED, THROTTLED, DROPPED]
+    # Other chats have their own bucket
+    assert flood.check(2) == ALLOWED
+    clock.now += 1
+    assert flood.check(1) == ALLOWED
+    assert flood.check(1) == THROTTLED
+
+
+def test_throttled_message_gets_one_notice():
+    flood = FloodControl(rate=1, burst=1, clock=Clock())
+    handled = []
+    handler = throttled(flood, 'slow down')(lambda update, context: handled.append(update) or 'STATE')
+    message = Recorder()
+    results = [handler(FakeUpdate(message=message), None) for _ in range(3)]
+    assert results == ['STATE', None, None]
+    assert len(handled) == 1
+    assert message.calls == [('reply_text', 'slow down')]
+
+
+def test_throttled_button_press_is_always_answered():
+    flood = FloodControl(rate=1, burst=1, clock=Clock())
+    handler = throttled(flood, 'slow down')(lambda update, context: 'STATE')
+    handler(FakeUpdate(callback_query=Recorder()), None)
+    queries = [Recorder(), Recorder()]
+    for query in queries:
+        assert handler(FakeUpdate(message=Recorder(), callback_query=query), None) is None
+    assert queries[0].calls == [('answer', 'slow down')]
+    assert queries[1].calls == [('answer', None)]
@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import Unauthorized
+
+from broadcast import Broadcaster
+from fakes import FakeBot, FakeClock
+from outbox import Outbox
+from storage import OUTBOX_MIGRATIONS, Database, migrate
+
+# Recent, so drain does not purge the delivered rows the tests look at
+DAY = datetime.date.today()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    db = Database(str(tmp_path / 'outbox.db'))
+    migrate(db, OUTBOX_MIGRATIONS)
+    yield Outbox(db, batch_size=2)
+    db.close()
+
+
+def broadcaster():
+    clock = FakeClock()
+    return Broadcaster(workers=1, global_rate=25, per_chat_rate=1, clock=clock, sleep=clock.sleep)
+
+
+class CrashingBroadcaster:
+    """
+    Delivers the first messages of a batch and then dies, like a process killed in the middle of a mailout.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def send(self, bot, messages, on_delivered=None):
+        for chat_id, chunks in messages[:self.deliver]:
+            for chunk in chunks:
+                bot.send_message(chat_id=chat_id, text=chunk)
+            on_delivered(chat_id, None)
+        raise RuntimeError("killed")
+
+
+def test_same_mailout_is_enqueued_once(outbox):
+    messages = [(1, 'one'), (2, 'two')]
+    assert outbox.enqueue('daily', DAY, messages) == 2
+    assert outbox.enqueue('daily', DAY, messages) == 0
+    # Another day or another reminder type is a new mailout
+    assert outbox.enqueue('weekly', DAY, messages) == 2
+    assert outbox.enqueue('daily', DAY + datetime.timedelta(days=1), messages) == 2
+
+
+def test_drain_after_sending_does_not_send_again(outbox):
+    bot = FakeBot()
+    outbox.enqueue('daily', DAY, [(1, 'one'), (2, 'two'), (3, 'three')])
+    report = outbox.drain(bot, broadcaster())
+    assert sorted(report.sent) == [1, 2, 3]
+    outbox.enqueue('daily', DAY, [(1, 'one'), (2, 'two'), (3, 'three')])
+    assert outbox.drain(bot, broadcaster()).sent == []
+    assert sorted(bot.sent) == [(1, 'one'), (2, 'two'), (3, 'three')]
+
+
+def test_drain_resumes_after_a_partial_run(outbox):
+    bot = FakeBot()
+    outbox.enqueue('daily', DAY, [(chat_id, 'hi %d' % chat_id) for chat_id in range(1, 6)])
+    with pytest.raises(RuntimeError):
+        outbox.drain(bot, CrashingBroadcaster(deliver=1))
+    assert len(bot.sent) == 1
+    report = outbox.drain(bot, broadcaster())
+    assert len(report.sent) == 4
+    assert sorted(chat_id for chat_id, _ in bot.sent) == [1, 2, 3, 4, 5]
+
+
+def test_failed_messages_are_not_retried(outbox):
+    bot = FakeBot(failures={2: [Unauthorized('blocked')]})
+    outbox.enqueue('daily', DAY, [(1, 'one'), (2, 'two')])
+    report = outbox.drain(bot, broadcaster())
+    assert report.sent == [1]
+    assert list(report.failed) == [2]
+    assert outbox.pending() == []
+    assert outbox.db.query("SELECT chat_id, status FROM outbox ORDER BY chat_id") == [(1, 'sent'), (2, 'failed')]
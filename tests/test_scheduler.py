@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+pytz = pytest.importorskip('pytz')
+
+from scheduler import ReminderScheduler, next_run, parse_reminder_time
+
+
+def utc(*args):
+    return pytz.utc.localize(datetime.datetime(*args))
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now.timestamp()
+
+
+def scheduler(now):
+    delivered = []
+    return ReminderScheduler(deliver=lambda *batch: delivered.append(batch), clock=Clock(now)), delivered
+
+
+def test_parse_reminder_time():
+    assert parse_reminder_time('8:05') == ('08:05', None)
+    assert parse_reminder_time(' 18.30 europe/london ') == ('18:30', 'Europe/London')
+    assert parse_reminder_time('24:00') is None
+    assert parse_reminder_time('18:30 Mars/Olympus') is None
+
+
+def test_next_run_in_the_users_time_zone():
+    # 10:00 in London is 09:00 UTC in summer time
+    assert next_run('daily', '10:00', 'Europe/London', utc(2026, 10, 19, 8)) == (utc(2026, 10, 19, 9),
+                                                                                 datetime.date(2026, 10, 19))
+    assert next_run('daily', '10:00', 'Europe/London', utc(2026, 10, 19, 9)) == (utc(2026, 10, 20, 9),
+                                                                                 datetime.date(2026, 10, 20))
+    # Already the next day in Auckland, the reminder date is the user's local date
+    assert next_run('daily', None, 'Pacific/Auckland', utc(2026, 10, 19, 20)) == (utc(2026, 10, 19, 21, 8),
+                                                                                  datetime.date(2026, 10, 20))
+
+
+def test_weekly_reminder_comes_on_sunday():
+    # Monday, the next Sunday is the day summer time ends, 19:00 CET is 18:00 UTC
+    assert next_run('weekly', None, 'CET', utc(2026, 10, 19, 12)) == (utc(2026, 10, 25, 18),
+                                                                      datetime.date(2026, 10, 25))
+    # On Sunday before the reminder time it is still today
+    assert next_run('weekly', '20:00', 'CET', utc(2026, 10, 18, 12))[1] == datetime.date(2026, 10, 18)
+
+
+def test_changed_settings_skip_the_old_entry():
+    reminders, delivered = scheduler(utc(2026, 10, 19, 7))
+    reminders.set(1, upcoming=1, remind_time='10:00', timezone='UTC')
+    reminders.set(1, remind_time='12:00')
+    assert reminders.run_pending(utc(2026, 10, 19, 10, 30)) == 0
+    assert reminders.run_pending(utc(2026, 10, 19, 12)) == 1
+    assert delivered == [('daily', datetime.date(2026, 10, 19), [1])]
+
+
+def test_removed_chat_gets_nothing():
+    reminders, delivered = scheduler(utc(2026, 10, 19, 7))
+    reminders.set(1, upcoming=1, remind_time='10:00', timezone='UTC')
+    reminders.remove(1)
+    assert reminders.run_pending(utc(2026, 10, 20, 12)) == 0
+    assert delivered == []
+
+
+def test_chats_due_together_are_delivered_in_one_batch_and_rescheduled():
+    reminders, delivered = scheduler(utc(2026, 10, 19, 7))
+    reminders.load([(1, 1, 0, '10:00', 'UTC'), (2, 1, 0, '10:00', 'UTC'), (3, 0, 0, None, None)])
+    assert reminders.run_pending(utc(2026, 10, 19, 10)) == 2
+    assert delivered == [('daily', datetime.date(2026, 10, 19), [1, 2])]
+    assert reminders.next_due() == utc(2026, 10, 20, 10)
+
+
+def test_sync_keeps_unchanged_entries():
+    reminders, delivered = scheduler(utc(2026, 10, 19, 7))
+    reminders.load([(1, 1, 0, '10:00', 'UTC'), (2, 1, 0, '10:00', 'UTC')])
+    size = len(reminders)
+    assert reminders.sync([(1, 1, 0, '10:00', 'UTC'), (2, 1, 0, '11:00', 'UTC')]) == 1
+    # Only the changed chat got a new entry, the old one is left stale in the heap
+    assert len(reminders) == size + 1
+    assert reminders.run_pending(utc(2026, 10, 19, 10)) == 1
+    assert delivered == [('daily', datetime.date(2026, 10, 19), [1])]
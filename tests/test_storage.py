@@ -0,0 +1,29 @@
+import sqlite3
+
+from storage import TASKS_MIGRATIONS, Database, migrate
+
+
+def tasks_db(path, rows):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE tasks (username TEXT, chat_id INTEGER, description TEXT, duedate TEXT)")
+    connection.executemany("INSERT INTO tasks VALUES (?,?,?,?)", rows)
+    connection.commit()
+    connection.close()
+    return Database(path)
+
+
+def test_tasks_migration_keeps_unreadable_dates(tmp_path):
+    db = tasks_db(str(tmp_path / 'todo.db'), [('ann', 1, 'Essay', '28/02/2021'), ('ann', 1, 'Lab', 'next friday')])
+    migrate(db, TASKS_MIGRATIONS)
+    assert db.query("SELECT description, duedate, duedate_raw FROM tasks ORDER BY description") == [
+        ('Essay', '2021-02-28', None), ('Lab', None, 'next friday')]
+    db.close()
+
+
+def test_tasks_migration_adds_raw_column_to_migrated_databases(tmp_path):
+    db = tasks_db(str(tmp_path / 'todo.db'), [('ann', 1, 'Essay', '2021-02-28')])
+    db.execute("PRAGMA user_version = 1")
+    migrate(db, TASKS_MIGRATIONS)
+    assert db.query("SELECT duedate, duedate_raw FROM tasks") == [('2021-02-28', None)]
+    assert db.query("PRAGMA user_version") == [(len(TASKS_MIGRATIONS),)]
+    db.close()
@@ -0,0 +1,86 @@
+import http.client
+import json
+
+import pytest
+
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = 'test-secret'
+
+
+@pytest.fixture
+def server():
+    server = WebhookServer(SECRET, port=0, queue_size=2, max_body=1024)
+    server.start()
+    yield server
+    server.stop()
+
+
+def post(server, body, secret=SECRET, path='/telegram'):
+    connection = http.client.HTTPConnection(*server.address, timeout=5)
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers[SECRET_HEADER] = secret
+    connection.request('POST', path, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response
+
+
+def update(update_id):
+    return json.dumps({'update_id': update_id, 'message': {'message_id': 1, 'text': '/start'}}).encode()
+
+
+def test_accepted_update_is_queued(server):
+    assert post(server, update(1)).status == 200
+    assert server.updates.get_nowait()['update_id'] == 1
+    assert server.counters['accepted'] == 1
+
+
+def test_wrong_or_missing_secret_is_rejected(server):
+    assert post(server, update(1), secret='wrong').status == 403
+    assert post(server, update(1), secret=None).status == 403
+    assert server.updates.empty()
+    assert server.counters['rejected_secret'] == 2
+
+
+def test_malformed_updates_get_400(server):
+    assert post(server, b'not json').status == 400
+    assert post(server, b'[1, 2]').status == 400
+    assert post(server, b'{"message": {}}').status == 400
+    assert server.counters['bad_request'] == 3
+
+
+def test_oversized_body_gets_413(server):
+    assert post(server, b'{"update_id": 1, "pad": "%s"}' % (b'x' * 2048)).status == 413
+    assert server.counters['too_large'] == 1
+    assert server.updates.empty()
+
+
+def test_full_queue_gets_503_with_retry_after(server):
+    assert post(server, update(1)).status == 200
+    assert post(server, update(2)).status == 200
+    response = post(server, update(3))
+    assert response.status == 503
+    assert response.getheader('Retry-After') == '1'
+    assert server.counters['rejected_full'] == 1
+    assert server.stats()['max_depth'] == 2
+
+
+def test_other_paths_and_stats_are_not_served(server):
+    assert post(server, update(1), path='/other').status == 404
+    connection = http.client.HTTPConnection(*server.address, timeout=5)
+    connection.request('GET', '/telegram/stats')
+    assert connection.getresponse().status == 501
+    connection.close()
+
+
+def test_accept_replays_captured_updates():
+    server = WebhookServer(SECRET, port=0)
+    try:
+        captured = [update(n) for n in range(5)]
+        assert [server.accept(body, SECRET) for body in captured] == [200] * 5
+        assert [server.updates.get_nowait()['update_id'] for _ in range(5)] == list(range(5))
+    finally:
+        server.stop()
@@ -0,0 +1,163 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Updates are a few KB, anything much bigger is not from Telegram
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    """
+    Embedded HTTP endpoint that receives updates pushed by Telegram, an alternative to long polling.
+    A request is only checked and put into a bounded queue, the reply goes back right away and the update
+    is handled by whoever consumes the queue. When the queue is full the request gets 503, Telegram then
+    delivers the update again later, so a burst slows down intake instead of piling up in memory.
+    The secret and the size of a request are checked before its body is read. The counters below are
+    exported on the metrics endpoint, not here, this listener is public.
+    """
+
+    def __init__(self, secret_token, host='127.0.0.1', port=8443, path='/telegram', queue_size=1000,
+                 max_body=MAX_BODY):
+        """
+        :param secret_token: value Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+        :param host: interface to listen on, usually behind a reverse proxy that terminates TLS
+        :param port: port to listen on
+        :param path: URL path updates are posted to
+        :param queue_size: maximum number of updates waiting to be handled
+        :param max_body: largest request body in bytes, bigger requests get 413
+        """
+        self.secret_token = secret_token
+        self.path = path
+        self.max_body = max_body
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.counters = {'received': 0, 'accepted': 0, 'rejected_full': 0, 'rejected_secret': 0,
+                         'bad_request': 0, 'too_large': 0, 'max_depth': 0}
+        self._counters_lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._request_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """
+        :return: dict with request counters, current and maximum queue depth
+        """
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['depth'] = self.updates.qsize()
+        stats['capacity'] = self.updates.maxsize
+        return stats
+
+    def _authorized(self, secret):
+        return secret is not None and hmac.compare_digest(secret.encode(), self.secret_token.encode())
+
+    def check_request(self, secret, length):
+        """
+        Checks a request before its body is read, so unauthenticated or oversized requests cost no memory.
+        :param secret: value of the secret token header, None if missing
+        :param length: value of the Content-Length header, None if missing or not a number
+        :return: HTTP status code to reject the request with, None if the body can be read
+        """
+        if not self._authorized(secret):
+            self._count('received')
+            self._count('rejected_secret')
+            return 403
+        if length is None or length < 0:
+            self._count('received')
+            self._count('bad_request')
+            return 400
+        if length > self.max_body:
+            self._count('received')
+            self._count('too_large')
+            return 413
+        return None
+
+    def accept(self, body, secret):
+        """
+        Checks and enqueues one posted update.
+        :param body: raw request body
+        :param secret: value of the secret token header, None if missing
+        :return: HTTP status code for the reply
+        """
+        self._count('received')
+        if not self._authorized(secret):
+            self._count('rejected_secret')
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self._count('bad_request')
+            return 400
+        if not isinstance(data, dict) or 'update_id' not in data:
+            self._count('bad_request')
+            return 400
+        try:
+            self.updates.put_nowait(data)
+        except queue.Full:
+            self._count('rejected_full')
+            return 503
+        with self._counters_lock:
+            self.counters['accepted'] += 1
+            self.counters['max_depth'] = max(self.counters['max_depth'], self.updates.qsize())
+        return 200
+
+    def _request_handler(self):
+        server = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def _reply(self, status, body=b'', content_type='text/plain'):
+                self.send_response(status)
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                secret = self.headers.get(SECRET_HEADER)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = None
+                status = server.check_request(secret, length)
+                if status is None:
+                    status = server.accept(self.rfile.read(length), secret)
+                self._reply(status)
+
+            def log_message(self, format, *args):
+                # Access logging for every update would put file I/O back on the request path
+                pass
+
+        return RequestHandler
+
+    def start(self):
+        """
+        Starts serving requests on a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info("Webhook listening on %s:%s%s", self.address[0], self.address[1], self.path)
+
+    def stop(self):
+        # shutdown() waits for serve_forever, which never runs if the server was not started
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()